@@ -1,23 +1,71 @@
-from typing import Union
+import atexit
+import json
+import logging
+import math
+import os
+import time
+from typing import Callable, Dict, Iterator, List, Union
+import uuid
 
 import dash
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
+from dash_table import DataTable
+import flask
 import pandas as pd
-from sqlalchemy import create_engine
+import plotly
 
-from database import db_path
+from cache import LRUCache
+from database import ReadOnlyDatabase, db_path
+import export
+from jobs import Job, JobManager, QueryRejected
+import query
 import sql_templates
+from timing import measure_time
 
 
+logger = logging.getLogger('toy_sql')
+
+# クエリごとにengineを生成すると接続の確立やPRAGMAの設定が毎回発生するため、
+# アプリ全体で1つのengineを共有する
+# TOY_SQL_IN_MEMORYに1を指定すると、DBをメモリ上に複製してクエリを実行する
+database = ReadOnlyDatabase(db_path, in_memory=os.environ.get('TOY_SQL_IN_MEMORY') == '1')
+atexit.register(database.dispose)
+
+# ページ表示で1ページに表示する行数
+page_size = 20
+
+# 1クエリあたりの実行時間の上限(秒)と、表形式で表示する行数の上限
+time_budget = float(os.environ.get('TOY_SQL_TIME_BUDGET', 5.0))
+max_rows = int(os.environ.get('TOY_SQL_MAX_ROWS', 10000))
+
+# ダウンロードでは全ての行を出力するため、表形式の表示より長い実行時間を許容する
+export_time_budget = float(os.environ.get('TOY_SQL_EXPORT_TIME_BUDGET', 300.0))
+export_chunk_size = 5000
+
+# クエリ結果のキャッシュ
+# キーにDBファイルの状態を含めるため、DBを再デプロイすると古い結果は参照されなくなる
+result_cache = LRUCache(max_entries=256, max_bytes=64 * 1024 * 1024)
+
+# クエリをバックグラウンドで実行するスレッドプール
+# 実行中のクエリの数がリクエストを処理するスレッド数を占有しないように、別のスレッドで実行する
+# 同時に実行するクエリ数はTOY_SQL_WORKERSまでで、1つのセッションが同時に実行できるクエリは1つまでとする
+# ページ表示、件数の計算、実行計画、ダウンロードのクエリはリクエストを処理するスレッドで直接実行するが、
+# ジョブと同じ実行枠を使い、空きがない場合は待たせずにbusy_messageを返す
+jobs = JobManager(max_workers=int(os.environ.get('TOY_SQL_WORKERS', 4)))
+atexit.register(jobs.shutdown)
+
+busy_message = '混雑しています。しばらくしてから再度実行してください'
+
 app = dash.Dash(
     name=__name__,
     external_stylesheets=[dbc.themes.BOOTSTRAP],
     title='Toy SQL Application'
 )
-app.layout = dbc.Container(
+layout = dbc.Container(
     children=[
         dbc.Row(
             className='bg-dark text-white p-1 mb-4',
@@ -41,7 +89,8 @@ app.layout = dbc.Container(
                                     options=[
                                         {'label': 'ドイツ語の国を人口が多い順に取得する', 'value': 'german_lines'},
                                         {'label': '宗教ごとに国を数える', 'value': 'count_by_religion_lines'},
-                                        {'label': '国名に「j」を含む国を取得する', 'value': 'contain_j_lines'}
+                                        {'label': '国名に「j」を含む国を取得する', 'value': 'contain_j_lines'},
+                                        {'label': '国名に「land」を含む国を検索インデックスで取得する', 'value': 'search_land_lines'}
                                     ]
                                 ),
                                 dbc.Button(
@@ -64,6 +113,31 @@ app.layout = dbc.Container(
                             n_clicks=0,
                             children='実行'
                         ),
+                        dbc.Button(
+                            id='sql-plan-button',
+                            className='mr-1',
+                            color='secondary',
+                            outline=True,
+                            n_clicks=0,
+                            children='実行計画'
+                        ),
+                        html.A(
+                            id='export-csv-link',
+                            className='btn btn-outline-success mr-1',
+                            children='CSV'
+                        ),
+                        html.A(
+                            id='export-arrow-link',
+                            className='btn btn-outline-success mr-1',
+                            children='Arrow'
+                        ),
+                        dcc.Checklist(
+                            id='checklist-paging',
+                            className='ml-2',
+                            style={'display': 'inline-block'},
+                            options=[{'label': 'ページ表示', 'value': 'yes'}],
+                            value=[]
+                        )
                     ]
                 ),
                 dbc.Col(
@@ -83,7 +157,28 @@ app.layout = dbc.Container(
             children=[
                 dbc.Col(
                     className='col-12',
-                    children=html.Div(id='sql-result')
+                    children=[
+                        html.Div(id='sql-plan'),
+                        html.Div(id='sql-result'),
+                        html.Div(
+                            id='sql-result-pages',
+                            style={'display': 'none'},
+                            children=[
+                                html.Div(id='sql-result-count', className='mb-1'),
+                                html.Div(id='sql-result-page-error'),
+                                html.Div(id='sql-result-page-rollup'),
+                                DataTable(
+                                    id='sql-result-table',
+                                    page_action='custom',
+                                    page_current=0,
+                                    page_size=page_size
+                                )
+                            ]
+                        ),
+                        dcc.Store(id='sql-query'),
+                        dcc.Store(id='sql-job'),
+                        dcc.Interval(id='sql-job-interval', interval=500, disabled=True)
+                    ]
                 )
             ]
         )
@@ -91,6 +186,187 @@ app.layout = dbc.Container(
 )
 
 
+def serve_layout() -> html.Div:
+    """ページを読み込むたびにレイアウトを生成する
+
+    ページごとに異なるセッションのidを設定し、同じページから投入されたジョブを識別する。
+
+    Returns
+    -------
+    dash_html_components.Div
+    """
+
+    component = html.Div(
+        children=[
+            dcc.Store(id='session-id', data=uuid.uuid4().hex),
+            layout
+        ]
+    )
+    return component
+
+
+app.layout = serve_layout
+
+
+def cached_query(kind: str, sql_text: str, run: Callable, *args):
+    """クエリ結果をキャッシュから取得する。キャッシュにない場合はクエリを実行する
+
+    キャッシュのキーは、正規化したSQL文とDBファイルの状態から生成する。
+
+    Parameters
+    ----------
+    kind : str
+        キャッシュする結果の種類
+    sql_text : str
+    run : Callable
+        engineを受け取り、クエリを実行して結果を返す関数
+    *args
+        結果を特定するための追加の値
+
+    Returns
+    -------
+    Any
+        runの戻り値
+    """
+
+    engine, fingerprint = database.current()
+    key = (kind, query.normalize_sql(sql_text), fingerprint) + args
+    return result_cache.get_or_compute(key, lambda: run(engine))
+
+
+def timeout_alert(e: query.QueryTimeout) -> html.Div:
+    """クエリが中断されたことを知らせるコンポーネントを生成する
+
+    Parameters
+    ----------
+    e : query.QueryTimeout
+
+    Returns
+    -------
+    dash_html_components.Div
+    """
+
+    component = html.Div(
+        className='alert alert-danger',
+        children=f'実行時間が上限の{time_budget}秒を超えたため、{e.elapsed:.2f}秒でクエリを中断しました'
+    )
+    return component
+
+
+def error_alert(e: Exception) -> html.Div:
+    """クエリの実行に失敗したことを知らせるコンポーネントを生成する
+
+    Parameters
+    ----------
+    e : Exception
+
+    Returns
+    -------
+    dash_html_components.Div
+    """
+
+    component = html.Div(
+        className='alert alert-danger',
+        children=f'クエリの実行に失敗しました : {e}'
+    )
+    return component
+
+
+def busy_alert() -> html.Div:
+    """実行できるクエリ数に空きがないため、クエリを受け付けなかったことを知らせるコンポーネントを生成する
+
+    Returns
+    -------
+    dash_html_components.Div
+    """
+
+    component = html.Div(
+        className='alert alert-warning',
+        children=busy_message
+    )
+    return component
+
+
+@app.server.route('/metrics/cache')
+def cache_metrics():
+    return flask.jsonify(result_cache.stats())
+
+
+@app.server.route('/metrics/jobs')
+def job_metrics():
+    return flask.jsonify(jobs.stats())
+
+
+@app.server.route('/export/<format_>')
+def export_sql(format_: str):
+    # 結果をカーソルからchunkごとに出力し、サーバーのメモリに全ての行を保持しない
+    exporters = {
+        'csv': (export.iter_csv, 'text/csv', 'result.csv'),
+        'arrow': (export.iter_arrow, 'application/vnd.apache.arrow.stream', 'result.arrow')
+    }
+    if format_ not in exporters:
+        flask.abort(404)
+
+    sql_text = flask.request.args.get('sql', '')
+    if not query.strip_sql(sql_text):
+        flask.abort(400)
+
+    iter_chunks, mimetype, filename = exporters[format_]
+    # ダウンロードのリンクにはページのセッションのidを含める。直接アクセスされた場合は接続元のアドレスで識別する
+    session_id = flask.request.args.get('session') or str(flask.request.remote_addr)
+    engine, _ = database.current()
+
+    def iter_held_chunks() -> Iterator:
+        # ダウンロードが終わるか中断されるまで、実行枠を保持する
+        with jobs.slot(session_id):
+            yield from iter_chunks(engine, sql_text, export_chunk_size, export_time_budget)
+
+    chunks = iter_held_chunks()
+
+    # レスポンスのヘッダを送信した後はエラーを返せないため、実行枠の取得やSQL文の誤り、型の推定で失敗する場合は、
+    # 最初のchunkを生成する時点で失敗させ、ダウンロードを始める前にエラーを返す
+    try:
+        first_chunk = next(chunks, None)
+    except QueryRejected:
+        return flask.Response(busy_message, status=503, mimetype='text/plain', headers={'Retry-After': '5'})
+    except query.QueryTimeout as e:
+        return flask.Response(f'実行時間が上限の{export_time_budget}秒を超えたため、{e.elapsed:.2f}秒でクエリを中断しました', status=400, mimetype='text/plain')
+    except Exception as e:
+        return flask.Response(f'クエリの実行に失敗しました : {e}', status=400, mimetype='text/plain')
+
+    def iter_response() -> Iterator:
+        # ダウンロードが中断された場合に、chunksも閉じられるようにジェネレータで包む
+        if first_chunk is not None:
+            yield first_chunk
+        yield from chunks
+
+    response = flask.Response(
+        iter_response(),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+    return response
+
+
+# ダウンロードのリンクはSQL文から組み立てるだけなので、ブラウザ上で更新する
+app.clientside_callback(
+    """
+    function(sqlText, sessionId) {
+        const query = '?sql=' + encodeURIComponent(sqlText || '') + '&session=' + encodeURIComponent(sessionId || '');
+        return ['/export/csv' + query, '/export/arrow' + query];
+    }
+    """,
+    output=[
+        Output('export-csv-link', 'href'),
+        Output('export-arrow-link', 'href')
+    ],
+    inputs=[
+        Input('sql-text', 'value'),
+        Input('session-id', 'data')
+    ]
+)
+
+
 @app.callback(
     output=Output('sql-text', 'value'),
     inputs=Input('sql-template-button', 'n_clicks'),
@@ -105,30 +381,355 @@ def write_sql_template(n_clicks: int, template_name: Union[str, None]) -> str:
         return sql_text
 
 
-@app.callback(
-    output=Output('sql-result', 'children'),
-    inputs=Input('sql-execution-button', 'n_clicks'),
-    state=State('sql-text', 'value')
-)
-def execute_sql(n_clicks: int, sql_text: str):
-    if n_clicks:
-        engine = create_engine(f'sqlite:///{db_path}')
-        df = pd.read_sql_query(sql_text, engine)
+def run_table_query(job: Job, sql_text: str) -> query.QueryResult:
+    """表形式で表示するクエリを実行する。結果がキャッシュにある場合はキャッシュから取得する
+
+    Parameters
+    ----------
+    job : jobs.Job
+        クエリを実行するジョブ
+    sql_text : str
+
+    Returns
+    -------
+    query.QueryResult
+        timingsには、キャッシュから取得した場合はcacheの段階だけが含まれる
+    """
+
+    start = time.perf_counter()
+    executed = False
+
+    def run(engine) -> query.QueryResult:
+        nonlocal executed
+        executed = True
+        return query.run_query(engine, sql_text, max_rows, time_budget, job.cancel_event, job.report_progress)
+
+    result = cached_query('table', sql_text, run)
+    if executed:
+        return result
+
+    return result._replace(timings={'cache': time.perf_counter() - start})
+
+
+def rollup_marker(rollup: str) -> html.Div:
+    """集計テーブルから結果を取得したことを知らせるコンポーネントを生成する
+
+    Parameters
+    ----------
+    rollup : str
+        集計テーブルのテーブル名
+
+    Returns
+    -------
+    dash_html_components.Div
+    """
+
+    component = html.Div(
+        className='alert alert-info',
+        children=f'集計テーブル {rollup} から結果を取得しました'
+    )
+    return component
 
+
+def render_result(result: query.QueryResult):
+    """クエリ結果を表形式で表示するコンポーネントを生成する
+
+    結果の下には、クエリの実行から表示用のデータの生成までの各段階の実行時間を表示する。
+    同じ内容をログにも出力する。
+
+    Parameters
+    ----------
+    result : query.QueryResult
+
+    Returns
+    -------
+    list[dash.development.base_component.Component]
+    """
+
+    timings: Dict[str, float] = dict(result.timings)
+
+    with measure_time(timings, 'dataframe'):
+        df = pd.DataFrame.from_records(result.rows, columns=result.columns)
+
+    with measure_time(timings, 'component'):
         table = dbc.Table.from_dataframe(
             df,
             bordered=True,
             hover=True
         )
-        return table
+
+    # Dashがレスポンスを生成するときと同じ方法でシリアライズし、ブラウザに送るデータ量を計測する
+    with measure_time(timings, 'serialize'):
+        payload_bytes = len(json.dumps(table, cls=plotly.utils.PlotlyJSONEncoder).encode())
+
+    logger.info(json.dumps({
+        'event': 'query_result',
+        'rows': len(result.rows),
+        'truncated': result.truncated,
+        'rollup': result.rollup,
+        'payload_bytes': payload_bytes,
+        'timings': timings
+    }))
+
+    breakdown = ', '.join(f'{stage} {seconds * 1000:.1f}ms' for stage, seconds in timings.items())
+    stats = html.Div(
+        className='text-muted small mb-3',
+        children=f'{len(result.rows)}行, {payload_bytes:,}バイト | {breakdown}'
+    )
+
+    components = [table, stats]
+
+    if result.rollup is not None:
+        components.insert(0, rollup_marker(result.rollup))
+
+    if result.truncated:
+        warning = html.Div(
+            className='alert alert-warning',
+            children=f'結果が{max_rows}行を超えたため、先頭の{max_rows}行のみを表示しています'
+        )
+        components.insert(0, warning)
+
+    return components
+
+
+def render_job(job: Job):
+    """ジョブの状態を表示するコンポーネントを生成する
+
+    Parameters
+    ----------
+    job : jobs.Job
+
+    Returns
+    -------
+    list[dash.development.base_component.Component]
+    """
+
+    if job.status == 'done':
+        return render_result(job.result)
+
+    elif job.status == 'failed' and isinstance(job.error, query.QueryTimeout):
+        return [timeout_alert(job.error)]
+
+    elif job.status == 'failed':
+        component = html.Div(
+            className='alert alert-danger',
+            children=f'クエリの実行に失敗しました : {job.error}'
+        )
+        return [component]
+
+    elif job.status == 'cancelled':
+        component = html.Div(
+            className='alert alert-secondary',
+            children='クエリはキャンセルされました'
+        )
+        return [component]
+
+    elif job.status == 'pending':
+        # 実行できるクエリ数に空きがない場合は、空くまで待たずに待ち順を表示する
+        position = jobs.position(job)
+        component = html.Div(
+            className='alert alert-warning',
+            children=f'混雑しています。実行待ち : {position}番目, 待ち時間 : {job.wait:.1f}秒'
+            if position is not None else '実行を開始しています...'
+        )
+        return [component]
+
+    else:
+        component = html.Div(
+            className='alert alert-secondary',
+            children=f'実行中... 経過時間 : {job.elapsed:.1f}秒, 取得行数 : {job.rows_fetched}'
+        )
+        return [component]
+
+
+@app.callback(
+    output=[
+        Output('sql-job', 'data'),
+        Output('sql-result-pages', 'style'),
+        Output('sql-result-table', 'page_current'),
+        Output('sql-query', 'data')
+    ],
+    inputs=Input('sql-execution-button', 'n_clicks'),
+    state=[
+        State('sql-text', 'value'),
+        State('checklist-paging', 'value'),
+        State('session-id', 'data')
+    ]
+)
+def execute_sql(n_clicks: int, sql_text: str, checklist_paging: List[str], session_id: str):
+    if n_clicks and checklist_paging:
+        # ページ表示では、表示中のページの行だけをfetch_sql_pageで取得する
+        return {'job_id': None}, {}, 0, {'sql': sql_text}
+
+    elif n_clicks:
+        # クエリはバックグラウンドで実行し、結果はpoll_sql_jobで取得する
+        job = jobs.submit(session_id, lambda job: run_table_query(job, sql_text))
+        return {'job_id': job.id_}, {'display': 'none'}, 0, None
 
     else:
+        return None, {'display': 'none'}, 0, None
+
+
+@app.callback(
+    output=[
+        Output('sql-result', 'children'),
+        Output('sql-job-interval', 'disabled')
+    ],
+    inputs=[
+        Input('sql-job', 'data'),
+        Input('sql-job-interval', 'n_intervals')
+    ]
+)
+def poll_sql_job(sql_job: Union[dict, None], n_intervals: int):
+    if sql_job is None:
         component = html.Div(
             className='alert alert-info',
             children='SQLクエリの結果が表示されます'
         )
-        return component
+        return component, True
+
+    elif sql_job['job_id'] is None:
+        return None, True
+
+    job = jobs.get(sql_job['job_id'])
+    if job is None:
+        component = html.Div(
+            className='alert alert-warning',
+            children='クエリの結果は破棄されました。再度実行してください'
+        )
+        return component, True
+
+    # ジョブが終了するまで、Intervalで状態を取得し続ける
+    return render_job(job), job.finished
+
+
+@app.callback(
+    output=Output('sql-plan', 'children'),
+    inputs=Input('sql-plan-button', 'n_clicks'),
+    state=[
+        State('sql-text', 'value'),
+        State('session-id', 'data')
+    ]
+)
+def explain_sql(n_clicks: int, sql_text: str, session_id: str):
+    if not n_clicks:
+        raise PreventUpdate
+
+    engine, _ = database.current()
+    try:
+        with jobs.slot(session_id):
+            plan = query.explain_query(engine, sql_text, time_budget)
+    except QueryRejected:
+        return busy_alert()
+    except query.QueryTimeout as e:
+        return timeout_alert(e)
+    except Exception as e:
+        return error_alert(e)
+
+    if plan.interrupted:
+        execution = f'実行時間 : {plan.elapsed:.4f}秒で中断 ({plan.num_rows}行まで取得)'
+    else:
+        execution = f'実行時間 : {plan.elapsed:.4f}秒 ({plan.num_rows}行)'
+
+    component = html.Div(
+        className='border border-secondary p-2 mb-3',
+        children=[
+            html.H6(children='実行計画'),
+            html.Div(
+                style={'white-space': 'pre', 'font-family': 'monospace', 'font-size': '14px'},
+                children='\n'.join(plan.lines)
+            ),
+            html.Div(className='mt-2', children=execution)
+        ]
+    )
+
+    if plan.rollup is not None:
+        # 実行計画には書き換えたクエリのテーブル名や別名しか現れないため、集計テーブルを使うことを明示する
+        note = html.Div(
+            className='text-muted small',
+            children=f'集計テーブル {plan.rollup} を使うように書き換えたクエリの実行計画です'
+        )
+        component.children.insert(1, note)
+
+    return component
+
+
+@app.callback(
+    output=[
+        Output('sql-result-table', 'columns'),
+        Output('sql-result-table', 'data'),
+        Output('sql-result-page-error', 'children'),
+        Output('sql-result-page-rollup', 'children')
+    ],
+    inputs=[
+        Input('sql-query', 'data'),
+        Input('sql-result-table', 'page_current'),
+        Input('sql-result-table', 'page_size')
+    ],
+    state=State('session-id', 'data')
+)
+def fetch_sql_page(sql_query: Union[dict, None], page_current: int, page_size: int, session_id: str):
+    if sql_query is None:
+        raise PreventUpdate
+
+    sql_text = sql_query['sql']
+
+    def run(engine):
+        # キャッシュにない場合だけ、実行枠を取得してクエリを実行する
+        with jobs.slot(session_id):
+            return query.fetch_page(engine, sql_text, page_current, page_size, time_budget)
+
+    try:
+        columns, rows, rollup = cached_query('page', sql_text, run, page_current, page_size)
+    except QueryRejected:
+        return [], [], busy_alert(), None
+    except query.QueryTimeout as e:
+        return [], [], timeout_alert(e), None
+    except Exception as e:
+        return [], [], error_alert(e), None
+
+    # 列名が重複する場合があるため、DataTableの列のidには列の位置を使う
+    table_columns = [{'id': str(i), 'name': c} for i, c in enumerate(columns)]
+    table_data = [{str(i): v for i, v in enumerate(row)} for row in rows]
+    marker = rollup_marker(rollup) if rollup is not None else None
+    return table_columns, table_data, None, marker
+
+
+@app.callback(
+    output=[
+        Output('sql-result-table', 'page_count'),
+        Output('sql-result-count', 'children')
+    ],
+    inputs=Input('sql-query', 'data'),
+    state=[
+        State('sql-result-table', 'page_size'),
+        State('session-id', 'data')
+    ]
+)
+def count_sql_rows(sql_query: Union[dict, None], page_size: int, session_id: str):
+    # 全件数の計算は最初のページの表示とは別のコールバックで行い、表示を待たせない
+    if sql_query is None:
+        raise PreventUpdate
+
+    sql_text = sql_query['sql']
+
+    def run(engine):
+        with jobs.slot(session_id):
+            return query.count_rows(engine, sql_text, time_budget)
+
+    try:
+        count = cached_query('count', sql_text, run)
+    except QueryRejected:
+        return dash.no_update, busy_message
+    except query.QueryTimeout as e:
+        return dash.no_update, f'件数の計算は{e.elapsed:.2f}秒で中断されました'
+    except Exception as e:
+        return dash.no_update, f'件数の計算に失敗しました : {e}'
+
+    page_count = max(math.ceil(count / page_size), 1)
+    return page_count, f'全{count}件'
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     app.run_server(debug=True)
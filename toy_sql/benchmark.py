@@ -0,0 +1,299 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import json
+import multiprocessing
+from pathlib import Path
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from database import ReadOnlyDatabase, db_path
+import query
+import sql_templates
+
+
+bench_dir = db_path.parent / 'bench'
+
+# ベンチマークで実行するクエリ。sql_templatesのクエリに、結合、集計、LIKEによる検索を加える
+workload: List[Tuple[str, str]] = [
+    ('german', '\n'.join(sql_templates.german_lines)),
+    ('count_by_religion', '\n'.join(sql_templates.count_by_religion_lines)),
+    ('contain_j', '\n'.join(sql_templates.contain_j_lines)),
+    (
+        'join_all',
+        'SELECT c.name, lm.name, z.quadrant, l.name, r.name '
+        'FROM country c '
+        'JOIN landmass lm ON c.landmass_id = lm.id '
+        'JOIN zone z ON c.zone_id = z.id '
+        'JOIN language l ON c.language_id = l.id '
+        'JOIN religion r ON c.religion_id = r.id '
+        'WHERE lm.name = "Europe"'
+    ),
+    (
+        'aggregate_landmass_zone',
+        'SELECT landmass_id, zone_id, COUNT(*), SUM(population), AVG(area) '
+        'FROM country GROUP BY landmass_id, zone_id'
+    ),
+    ('top_population', 'SELECT name, population FROM country ORDER BY population DESC LIMIT 10'),
+    ('like_prefix', 'SELECT name FROM country WHERE name LIKE "Ger%"'),
+    ('like_substring', 'SELECT name FROM country WHERE name LIKE "%land%"'),
+]
+
+
+def peak_rss_bytes() -> int:
+    """プロセスのこれまでの最大常駐メモリサイズを取得する
+
+    Returns
+    -------
+    int
+        バイト数
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrssの単位は、macOSではバイト、Linuxではキロバイト
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_in_new_process(function: Callable, *args) -> Any:
+    """関数を新しく起動したプロセスで実行し、結果を返す
+
+    ru_maxrssはプロセスが起動してからの最大値のため、計測ごとにプロセスを分けて、
+    他の計測やDBのデプロイで使ったメモリが含まれないようにする。
+    forkでは親プロセスのメモリを引き継ぐため、spawnでプロセスを起動する。
+
+    Parameters
+    ----------
+    function : Callable
+        モジュールの最上位で定義された関数
+    *args
+        functionに渡す引数
+
+    Returns
+    -------
+    Any
+        functionの戻り値
+    """
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(function, *args).result()
+
+
+def git_commit() -> Optional[str]:
+    """ベンチマークを実行したコミットのハッシュ値を取得する
+
+    Returns
+    -------
+    str or None
+        gitリポジトリでない場合はNone
+    """
+
+    try:
+        output = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return output.stdout.strip()
+
+
+def build_db(num_synthetic_rows: int) -> Path:
+    """ベンチマーク用のDBをデプロイする
+
+    入力に変更がない場合、deploy_db.mainは既存のDBを再利用する。
+
+    Parameters
+    ----------
+    num_synthetic_rows : int
+        元のデータに加えて生成する架空の国の数
+
+    Returns
+    -------
+    pathlib.Path
+        デプロイしたDBのパス
+    """
+
+    # pandasを使うデプロイ処理は、クエリを計測するプロセスで読み込まないように、この関数の中で読み込む
+    import deploy_db
+
+    path = bench_dir / f'db_{num_synthetic_rows}.sqlite'
+    # 結果をJSONで標準出力に出力するため、デプロイのログは標準エラー出力に出力する
+    with redirect_stdout(sys.stderr):
+        deploy_db.main(num_synthetic_rows, seed=0, path=path)
+
+    return path
+
+
+def run_workload(
+    engine, name: str, sql_text: str, repeat: int, max_rows: int, time_budget: float
+) -> Dict[str, object]:
+    """1つのクエリを繰り返し実行し、レイテンシを計測する
+
+    execute_sqlのジョブと同じくquery.run_queryでクエリを実行する。
+    結果のキャッシュは経由しないため、毎回SQLiteでクエリが実行される。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine
+    name : str
+        クエリの名前
+    sql_text : str
+    repeat : int
+        計測する回数。計測前に1回、ウォームアップのために実行する
+    max_rows : int
+        取得する行数の上限
+    time_budget : float
+        実行時間の上限(秒)
+
+    Returns
+    -------
+    dict[str, object]
+    """
+
+    try:
+        query.run_query(engine, sql_text, max_rows, time_budget)
+    except query.QueryTimeout:
+        pass
+
+    latencies = []
+    num_rows = 0
+    timeouts = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            result = query.run_query(engine, sql_text, max_rows, time_budget)
+            num_rows += len(result.rows)
+        except query.QueryTimeout:
+            timeouts += 1
+        latencies.append(time.perf_counter() - start)
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    total = sum(latencies)
+    return {
+        'query': name,
+        'repeat': repeat,
+        'rows': num_rows // repeat,
+        'timeouts': timeouts,
+        'p50_ms': p50 * 1000,
+        'p95_ms': p95 * 1000,
+        'p99_ms': p99 * 1000,
+        'mean_ms': total / repeat * 1000,
+        'rows_per_sec': num_rows / total if total > 0 else None
+    }
+
+
+def measure_workload(
+    path: Path, in_memory: bool, name: str, sql_text: str, repeat: int, max_rows: int, time_budget: float
+) -> Dict[str, object]:
+    """DBを開いて1つのクエリのレイテンシとメモリ使用量を計測する
+
+    run_in_new_processで、計測ごとに新しいプロセスで実行する。
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        ベンチマーク用のDBのパス
+    in_memory : bool
+        Trueの場合、インメモリDBの複製に対してクエリを実行する
+    name : str
+        クエリの名前
+    sql_text : str
+    repeat : int
+        計測する回数
+    max_rows : int
+        取得する行数の上限
+    time_budget : float
+        実行時間の上限(秒)
+
+    Returns
+    -------
+    dict[str, object]
+        run_workloadの結果に、プロセスの最大常駐メモリサイズと、
+        DBを開いてクエリを実行したことによるその増加量を加えたもの
+    """
+
+    baseline_rss = peak_rss_bytes()
+
+    database = ReadOnlyDatabase(path, in_memory=in_memory)
+    engine, _ = database.current()
+    result = run_workload(engine, name, sql_text, repeat, max_rows, time_budget)
+    database.dispose()
+
+    peak_rss = peak_rss_bytes()
+    result['peak_rss_bytes'] = peak_rss
+    result['rss_increase_bytes'] = peak_rss - baseline_rss
+    return result
+
+
+def main(sizes: List[int], repeat: int, max_rows: int, time_budget: float, in_memory: bool) -> dict:
+    """DBのサイズごとにワークロードを実行し、結果を出力する
+
+    Parameters
+    ----------
+    sizes : List[int]
+        架空の国の数のリスト。それぞれの数でDBをデプロイしてワークロードを実行する
+    repeat : int
+        1クエリあたりの計測回数
+    max_rows : int
+        取得する行数の上限
+    time_budget : float
+        実行時間の上限(秒)
+    in_memory : bool
+        Trueの場合、インメモリDBの複製に対してクエリを実行する
+
+    Returns
+    -------
+    dict
+    """
+
+    results = []
+    for size in sizes:
+        path = run_in_new_process(build_db, size)
+
+        for name, sql_text in workload:
+            result = run_in_new_process(
+                measure_workload, path, in_memory, name, sql_text, repeat, max_rows, time_budget
+            )
+            result['synthetic_rows'] = size
+            results.append(result)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'in_memory': in_memory,
+        'max_rows': max_rows,
+        'results': results
+    }
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SQLクエリのベンチマークを実行し、結果をJSONで出力する')
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[0, 100000, 1000000],
+        help='DBに追加する架空の国の数。複数指定できる'
+    )
+    parser.add_argument('--repeat', type=int, default=20, help='1クエリあたりの計測回数')
+    parser.add_argument('--max-rows', type=int, default=10000, help='取得する行数の上限')
+    parser.add_argument('--time-budget', type=float, default=30.0, help='1クエリあたりの実行時間の上限(秒)')
+    parser.add_argument('--in-memory', action='store_true', help='インメモリDBの複製に対してクエリを実行する')
+    parser.add_argument('--output', type=Path, default=None, help='結果を出力するファイル。省略した場合は標準出力')
+    args = parser.parse_args()
+
+    report = main(args.sizes, args.repeat, args.max_rows, args.time_budget, args.in_memory)
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        args.output.write_text(text)
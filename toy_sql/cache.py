@@ -0,0 +1,145 @@
+from collections import OrderedDict
+import sys
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+import pandas as pd
+
+
+def estimate_nbytes(value: Any) -> int:
+    """キャッシュする値のおおよそのメモリ使用量を求める
+
+    Parameters
+    ----------
+    value : Any
+        pandas.DataFrame、またはlist、tuple、スカラー値を組み合わせた値
+
+    Returns
+    -------
+    int
+        バイト数
+    """
+
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+
+    elif isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_nbytes(v) for v in value)
+
+    else:
+        return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """エントリ数とバイト数の上限を持つスレッドセーフなLRUキャッシュ
+
+    上限を超えた場合は、最も長く参照されていないエントリから破棄する。
+
+    Parameters
+    ----------
+    max_entries : int
+        保持するエントリ数の上限
+    max_bytes : int
+        保持する値の合計バイト数の上限
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        assert max_entries > 0
+        assert max_bytes > 0
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self._nbytes: Dict[Hashable, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """キャッシュされた値を返す。存在しない場合はcomputeで計算してキャッシュする
+
+        Parameters
+        ----------
+        key : Hashable
+        compute : Callable[[], Any]
+            キャッシュミス時に値を計算する関数
+
+        Returns
+        -------
+        Any
+        """
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+            self.misses += 1
+
+        # 計算中はロックを保持しない。同じキーが同時に計算されることはあり得るが、結果は同じになる
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        """値をキャッシュする
+
+        値のバイト数がmax_bytesを超える場合はキャッシュしない。
+
+        Parameters
+        ----------
+        key : Hashable
+        value : Any
+        """
+
+        nbytes = estimate_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._nbytes[key]
+
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._nbytes[key] = nbytes
+            self._total_bytes += nbytes
+
+            while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._total_bytes -= self._nbytes.pop(evicted_key)
+                self.evictions += 1
+
+    def clear(self):
+        """全てのエントリを破棄する"""
+
+        with self._lock:
+            self._entries.clear()
+            self._nbytes.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """キャッシュの統計情報を出力する
+
+        Returns
+        -------
+        dict[str, Any]
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else None
+            }
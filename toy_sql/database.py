@@ -1,13 +1,63 @@
 from contextlib import contextmanager
 from pathlib import Path
+import sqlite3
+import threading
+from typing import Optional, Tuple
 
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateTable
 
 
 db_path = Path(__file__).with_name('data') / 'db.sqlite'
 
+# 国名の部分一致検索に使う、FTS5のtrigramインデックスのテーブル名
+search_index_name = 'country_name_fts'
+
+# countryテーブルを集計した集計テーブルを作成する分類のテーブル名
+rollup_dimensions = ['landmass', 'zone', 'language', 'religion']
+
+# 読み取り専用の接続に設定するPRAGMA
+# mmap_sizeとcache_sizeはバイト数、cache_sizeは負の値でKiB単位の指定となる。
+# 参照: https://www.sqlite.org/pragma.html
+read_only_pragmas = {
+    'query_only': 'ON',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# ユーザーのSQL文で実行を許可するPRAGMA
+# 接続はプールで複数のユーザーに共有されるため、接続の状態を変えるPRAGMAは実行させない
+# テーブル名などを引数に取り、スキーマを参照するだけのPRAGMA
+schema_pragmas = {
+    'table_info', 'table_xinfo', 'table_list', 'index_info', 'index_xinfo', 'index_list', 'foreign_key_list',
+    'database_list', 'collation_list', 'function_list', 'module_list', 'pragma_list', 'compile_options',
+}
+# 値を変更せずに参照する場合だけ許可するPRAGMA
+# data_versionはFTS5が、read_uncommittedはSQLAlchemyが内部で参照する
+readable_pragmas = set(read_only_pragmas) | {
+    'data_version', 'schema_version', 'user_version', 'application_id', 'encoding', 'foreign_keys',
+    'page_count', 'page_size', 'freelist_count', 'journal_mode', 'read_uncommitted',
+}
+
+# ユーザーのSQL文で禁止する、DBや接続のスキーマに書き込む操作
+write_actions = {
+    sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE, sqlite3.SQLITE_DELETE,
+    sqlite3.SQLITE_CREATE_TABLE, sqlite3.SQLITE_CREATE_INDEX, sqlite3.SQLITE_CREATE_VIEW, sqlite3.SQLITE_CREATE_TRIGGER,
+    sqlite3.SQLITE_CREATE_TEMP_TABLE, sqlite3.SQLITE_CREATE_TEMP_INDEX, sqlite3.SQLITE_CREATE_TEMP_VIEW,
+    sqlite3.SQLITE_CREATE_TEMP_TRIGGER, sqlite3.SQLITE_CREATE_VTABLE,
+    sqlite3.SQLITE_DROP_TABLE, sqlite3.SQLITE_DROP_INDEX, sqlite3.SQLITE_DROP_VIEW, sqlite3.SQLITE_DROP_TRIGGER,
+    sqlite3.SQLITE_DROP_TEMP_TABLE, sqlite3.SQLITE_DROP_TEMP_INDEX, sqlite3.SQLITE_DROP_TEMP_VIEW,
+    sqlite3.SQLITE_DROP_TEMP_TRIGGER, sqlite3.SQLITE_DROP_VTABLE,
+    sqlite3.SQLITE_ALTER_TABLE, sqlite3.SQLITE_REINDEX, sqlite3.SQLITE_ANALYZE,
+}
+# pragma_table_infoなどのテーブル値関数は、内部でスキーマのテーブルへのUPDATEとして判定されるため許可する
+# これらのテーブルは、PRAGMA writable_schemaを変更しない限りユーザーのSQL文では更新できない
+schema_tables = {'sqlite_master', 'sqlite_temp_master', 'sqlite_schema', 'sqlite_temp_schema'}
+
 
 @contextmanager
 def session_scope(engine):
@@ -35,6 +85,263 @@ def session_scope(engine):
         session.close()
 
 
+def db_fingerprint(path: Path) -> Tuple[int, int, int]:
+    """DBファイルが更新されたかを判定するための値を取得する
+
+    DBを再デプロイするとファイルが作り直されるため、値が変化する。
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        SQLite DBのパス
+
+    Returns
+    -------
+    tuple[int, int, int]
+        ファイルのinode番号、サイズ、更新時刻(ナノ秒)
+    """
+
+    stat = path.stat()
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def create_read_only_engine(path: Path, pool_size: int = 8):
+    """SQLite DBを読み取り専用で開くengineを生成する
+
+    各接続は`mode=ro`のURIで開く。
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        SQLite DBのパス
+    pool_size : int, optional
+        保持する接続数の上限。デフォルト値は8
+
+    Returns
+    -------
+    sqlalchemy.engine.base.Engine
+    """
+
+    return create_uri_engine(f'{path.resolve().as_uri()}?mode=ro', pool_size)
+
+
+def create_uri_engine(uri: str, pool_size: int = 8):
+    """SQLiteのURIで指定したDBを開くengineを生成する
+
+    接続はプールに最大pool_size個保持され、クエリの実行中は1つのスレッドが専有する。
+    実行が終わるとプールに返却され、別のスレッドのクエリで再利用される。
+    プールの接続が全て使用中の場合は、一時的な接続を追加で開き、返却時に閉じる。
+    各接続にはread_only_pragmasのPRAGMAを設定する。
+
+    Parameters
+    ----------
+    uri : str
+        SQLiteのURI
+        参照: https://www.sqlite.org/uri.html
+    pool_size : int, optional
+        プールに保持する接続数の上限。デフォルト値は8
+
+    Returns
+    -------
+    sqlalchemy.engine.base.Engine
+    """
+
+    def connect() -> sqlite3.Connection:
+        # 接続はプールから取り出したスレッドだけが使うが、取り出すスレッドはクエリごとに異なるため、
+        # check_same_threadを無効にする
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    # SingletonThreadPoolはスレッド数がpool_sizeを超えると、他のスレッドが使用中の接続を閉じることがあるため、
+    # 接続を取り出している間は他のスレッドに渡さないQueuePoolを使う
+    engine = create_engine(
+        'sqlite://',
+        creator=connect,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=-1
+    )
+    # PRAGMAを設定してから、以降のPRAGMAによる変更を禁止する
+    event.listen(engine, 'connect', set_read_only_pragmas)
+    event.listen(engine, 'connect', set_read_only_authorizer)
+    return engine
+
+
+def create_memory_replica(path: Path, name: str) -> Tuple[sqlite3.Connection, str]:
+    """SQLite DBを、共有キャッシュのインメモリDBに複製する
+
+    インメモリDBは、同じURIで開いた接続が1つでも残っている間だけ存在する。
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        複製元のSQLite DBのパス
+    name : str
+        インメモリDBの名前
+
+    Returns
+    -------
+    keeper : sqlite3.Connection
+        インメモリDBを保持するための接続
+    uri : str
+        インメモリDBを開くためのURI
+    """
+
+    uri = f'file:{name}?mode=memory&cache=shared'
+    keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    source = sqlite3.connect(f'{path.resolve().as_uri()}?mode=ro', uri=True)
+    try:
+        source.backup(keeper)
+    finally:
+        source.close()
+
+    return keeper, uri
+
+
+def set_read_only_pragmas(dbapi_connection: sqlite3.Connection, connection_record):
+    """接続時に読み取り専用のPRAGMAを設定する
+
+    Parameters
+    ----------
+    dbapi_connection : sqlite3.Connection
+    connection_record : sqlalchemy.pool._ConnectionRecord
+    """
+
+    cursor = dbapi_connection.cursor()
+    for name, value in read_only_pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+def read_only_authorizer(action: int, arg1: Optional[str], arg2: Optional[str], db_name: Optional[str], trigger_name: Optional[str]) -> int:
+    """読み取り専用の接続で、SQL文の各操作を許可するかを判定する
+
+    他のDBファイルのATTACHとDETACH、schema_pragmasとreadable_pragmas以外のPRAGMA、write_actionsの操作を禁止する。
+    PRAGMA query_only = OFFのようにユーザーのSQL文でPRAGMAを変更すると、プールで同じ接続を使う他のユーザーの
+    クエリにも影響するため、PRAGMAによる設定はread_only_pragmasの値から変えられないようにする。
+    インメモリの複製はmode=roで開けないため、書き込みはPRAGMA query_onlyに頼らずここで禁止する。
+    参照: https://www.sqlite.org/c3ref/set_authorizer.html
+
+    Parameters
+    ----------
+    action : int
+        操作の種類を表すsqlite3.SQLITE_*の定数
+    arg1, arg2 : str or None
+        操作の対象。PRAGMAの場合はPRAGMAの名前と値
+    db_name : str or None
+        操作の対象のDB名
+    trigger_name : str or None
+        操作がトリガーやビューの中で行われる場合は、その名前
+
+    Returns
+    -------
+    int
+        sqlite3.SQLITE_OKかsqlite3.SQLITE_DENY
+    """
+
+    if action in (sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH):
+        return sqlite3.SQLITE_DENY
+
+    if action == sqlite3.SQLITE_PRAGMA:
+        name = (arg1 or '').lower()
+        if name in schema_pragmas or (name in readable_pragmas and arg2 is None):
+            return sqlite3.SQLITE_OK
+        return sqlite3.SQLITE_DENY
+
+    if action in write_actions:
+        if action == sqlite3.SQLITE_UPDATE and (arg1 or '').lower() in schema_tables:
+            return sqlite3.SQLITE_OK
+        return sqlite3.SQLITE_DENY
+
+    return sqlite3.SQLITE_OK
+
+
+def set_read_only_authorizer(dbapi_connection: sqlite3.Connection, connection_record):
+    """接続時に、読み取り専用の接続で禁止する操作を判定する関数を設定する
+
+    Parameters
+    ----------
+    dbapi_connection : sqlite3.Connection
+    connection_record : sqlalchemy.pool._ConnectionRecord
+    """
+
+    dbapi_connection.set_authorizer(read_only_authorizer)
+
+
+class ReadOnlyDatabase(object):
+    """読み取り専用のengineを保持し、DBが再デプロイされた場合はengineを作り直すクラス
+
+    in_memoryがTrueの場合は、DBファイルを共有キャッシュのインメモリDBに複製し、
+    クエリはインメモリDBに対して実行する。DBファイルが更新されたら複製し直す。
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        SQLite DBのパス
+    pool_size : int, optional
+        engineが保持する接続数の上限。デフォルト値は8
+    in_memory : bool, optional
+        Trueの場合、インメモリDBの複製に対してクエリを実行する。デフォルト値はFalse
+    """
+
+    def __init__(self, path: Path, pool_size: int = 8, in_memory: bool = False):
+        self.path = path
+        self.pool_size = pool_size
+        self.in_memory = in_memory
+
+        self._engine = None
+        self._fingerprint = None
+        self._replica_keeper: Optional[sqlite3.Connection] = None
+        self._replica_version = 0
+        self._lock = threading.Lock()
+
+    def current(self):
+        """現在のDBファイルを参照するengineと、DBファイルの状態を取得する
+
+        Returns
+        -------
+        engine : sqlalchemy.engine.base.Engine
+        fingerprint : tuple[int, int, int]
+            db_fingerprintの値
+        """
+
+        fingerprint = db_fingerprint(self.path)
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                # 古いengineの接続は他のスレッドがクエリの実行中に使っている可能性があるため、
+                # 明示的に閉じず、参照がなくなった時点で閉じられるようにする
+                if self.in_memory:
+                    self._engine = self._create_replica_engine()
+                else:
+                    self._engine = create_read_only_engine(self.path, self.pool_size)
+                self._fingerprint = fingerprint
+
+            return self._engine, fingerprint
+
+    def dispose(self):
+        """engineが保持する接続を全て閉じる"""
+
+        with self._lock:
+            if self._engine is not None:
+                self._engine.dispose()
+            if self._replica_keeper is not None:
+                self._replica_keeper.close()
+                self._replica_keeper = None
+
+    def _create_replica_engine(self):
+        # 複製ごとに別の名前のインメモリDBを作成し、古い複製を参照している接続に影響しないようにする。
+        # 古い複製は、それを参照する接続が全て閉じられた時点で破棄される。
+        self._replica_version += 1
+        name = f'toy_sql_replica_{id(self)}_{self._replica_version}'
+        keeper, uri = create_memory_replica(self.path, name)
+
+        if self._replica_keeper is not None:
+            self._replica_keeper.close()
+        self._replica_keeper = keeper
+
+        return create_uri_engine(uri, self.pool_size)
+
+
 # mypyのtypeチェックにBaseを適応するとエラーになる。
 # Baseは動的クラスなので、静的な型のチェックができないため。
 # そのため、Baseを継承させたクラスを定義するとき「type: ignore」を指定してチェックを回避する。
@@ -46,12 +353,13 @@ class Country(Base):  # type: ignore
     __tablename__ = 'country'
 
     name = Column(String, primary_key=True)
-    landmass_id = Column(Integer, nullable=False)
-    zone_id = Column(Integer, nullable=False)
+    # 他のテーブルと結合する列には、結合時に全件走査とならないようにインデックスを作成する
+    landmass_id = Column(Integer, nullable=False, index=True)
+    zone_id = Column(Integer, nullable=False, index=True)
     area = Column(Integer, nullable=False)
     population = Column(Integer, nullable=False)
-    language_id = Column(Integer, nullable=False)
-    religion_id = Column(Integer, nullable=False)
+    language_id = Column(Integer, nullable=False, index=True)
+    religion_id = Column(Integer, nullable=False, index=True)
 
 
 class Landmass(Base):  # type: ignore
@@ -85,8 +393,109 @@ class Religion(Base):  # type: ignore
 def create_db(engine):
     """DBをengineに与えられたパスに生成する
 
+    テーブルと、countryテーブルの外部キー列のインデックス、国名の検索インデックス、集計テーブルを作成する。
+    検索インデックスと集計テーブルは作成時点のcountryテーブルの内容から作成されるため、
+    行を挿入した後は、create_search_indexとcreate_rollupsで作り直す。
+
     Parameters
     ----------
     engine : sqlalchemy.engine.base.Engine
     """
     Base.metadata.create_all(engine)
+    create_search_index(engine)
+    create_rollups(engine)
+
+
+def create_tables(engine):
+    """インデックスを作成せずに、テーブルだけを作成する
+
+    大量のデータを挿入する場合は、挿入後にcreate_indexesでインデックスを作成した方が速い。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine or sqlalchemy.engine.base.Connection
+    """
+
+    for table in Base.metadata.sorted_tables:
+        engine.execute(CreateTable(table))
+
+
+def create_indexes(engine):
+    """create_tablesで作成したテーブルのインデックスを作成する
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine or sqlalchemy.engine.base.Connection
+    """
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine)
+
+
+def create_search_index(engine) -> bool:
+    """countryテーブルの国名に、部分一致検索のためのFTS5のtrigramインデックスを作成する
+
+    インデックスはcountryテーブルを外部コンテンツとするFTS5テーブルで、作成時点のcountryテーブルの
+    内容から構築される。countryテーブルを更新した後は、この関数を再度呼び出して構築し直す。
+    trigramトークナイザはSQLite 3.34.0以降で使えるため、それより古い場合は作成しない。
+    参照: https://www.sqlite.org/fts5.html#the_trigram_tokenizer
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine or sqlalchemy.engine.base.Connection
+
+    Returns
+    -------
+    bool
+        インデックスを作成した場合にTrue
+    """
+
+    if sqlite3.sqlite_version_info < (3, 34, 0):
+        return False
+
+    engine.execute(
+        f'CREATE VIRTUAL TABLE IF NOT EXISTS {search_index_name} USING fts5('
+        f"name, content='country', content_rowid='rowid', tokenize='trigram')"
+    )
+    engine.execute(f"INSERT INTO {search_index_name}({search_index_name}) VALUES ('rebuild')")
+    return True
+
+
+def rollup_table_name(dimension: str) -> str:
+    """集計テーブルのテーブル名を取得する
+
+    Parameters
+    ----------
+    dimension : str
+        rollup_dimensionsのいずれか
+
+    Returns
+    -------
+    str
+    """
+
+    return f'rollup_country_by_{dimension}'
+
+
+def create_rollups(engine):
+    """countryテーブルを分類ごとに集計した集計テーブルを作成する
+
+    集計テーブルは、作成時点のcountryテーブルの内容から作成される。
+    各集計テーブルは分類のid列と、国の数、人口と面積の合計、最小値、最大値の列を持つ。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine or sqlalchemy.engine.base.Connection
+    """
+
+    for dimension in rollup_dimensions:
+        table_name = rollup_table_name(dimension)
+        engine.execute(f'DROP TABLE IF EXISTS {table_name}')
+        engine.execute(
+            f'CREATE TABLE {table_name} AS '
+            f'SELECT {dimension}_id, COUNT(*) AS country_count, '
+            'SUM(population) AS population_sum, MIN(population) AS population_min, MAX(population) AS population_max, '
+            'SUM(area) AS area_sum, MIN(area) AS area_min, MAX(area) AS area_max '
+            f'FROM country GROUP BY {dimension}_id'
+        )
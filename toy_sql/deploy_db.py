@@ -1,10 +1,22 @@
+import argparse
+import hashlib
+from itertools import chain, islice
+import os
 from pathlib import Path
+import sqlite3
+import tempfile
+from typing import Dict, Iterable, Iterator, Optional
 
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine
 
 import database
-from database import db_path, session_scope
+from database import db_path
+from timing import measure_time
+
+
+csv_path = Path(__file__).with_name('data') / 'flags.csv'
 
 
 def fetch_csv() -> pd.DataFrame:
@@ -38,94 +50,344 @@ def load_csv() -> pd.DataFrame:
     pandas.DataFrame
     """
 
-    csv_dir = Path(__file__).with_name('data')
-    csv_path = csv_dir / 'flags.csv'
-
     if csv_path.exists():
         df = pd.read_csv(csv_path)
 
     else:
         df = fetch_csv()
 
-        csv_dir.mkdir(exist_ok=True)
+        csv_path.parent.mkdir(exist_ok=True)
         df.to_csv(csv_path, index=False)
 
     return df
 
 
-def main():
-    """.data/db.sqliteにSQLite DBをデプロイする
+# 各テーブルに挿入する行を、1回のexecutemanyにまとめる件数
+insert_batch_size = 10000
 
-    DBテーブルを作成し、dfからデータを生成して各テーブルに挿入する。
+landmasses = [
+    {'id': 1, 'name': 'N.America'},
+    {'id': 2, 'name': 'S.America'},
+    {'id': 3, 'name': 'Europe'},
+    {'id': 4, 'name': 'Africa'},
+    {'id': 5, 'name': 'Asia'},
+    {'id': 6, 'name': 'Oceania'},
+]
+zones = [
+    {'id': 1, 'quadrant': 'NE'},
+    {'id': 2, 'quadrant': 'SE'},
+    {'id': 3, 'quadrant': 'SW'},
+    {'id': 4, 'quadrant': 'NW'},
+]
+languages = [
+    {'id': 1, 'name': 'English'},
+    {'id': 2, 'name': 'Spanish'},
+    {'id': 3, 'name': 'French'},
+    {'id': 4, 'name': 'German'},
+    {'id': 5, 'name': 'Slavic'},
+    {'id': 6, 'name': 'Other Indo-European'},
+    {'id': 7, 'name': 'Chinese'},
+    {'id': 8, 'name': 'Arabic'},
+    {'id': 9, 'name': 'Japanese/Turkish/Finnish/Magyar'},
+    {'id': 10, 'name': 'Others'},
+]
+religions = [
+    {'id': 0, 'name': 'Catholic'},
+    {'id': 1, 'name': 'Other Christian'},
+    {'id': 2, 'name': 'Muslim'},
+    {'id': 3, 'name': 'Buddhist'},
+    {'id': 4, 'name': 'Hindu'},
+    {'id': 5, 'name': 'Ethnic'},
+    {'id': 6, 'name': 'Marxist'},
+    {'id': 7, 'name': 'Others'},
+]
+
+
+def print_timings(timings: Dict[str, float]):
+    """measure_timeで計測した実行時間を出力する
+
+    Parameters
+    ----------
+    timings : dict[str, float]
+        処理名をkey、実行時間(秒)をvalueとするdict
+    """
+
+    width = max(len(stage) for stage in timings)
+    print('処理時間')
+    for stage, seconds in timings.items():
+        print(f'  {stage:<{width}} : {seconds:.3f}秒')
+    print(f'  {"total":<{width}} : {sum(timings.values()):.3f}秒')
+
+
+def iter_country_rows(df: pd.DataFrame) -> Iterator[dict]:
+    """dfの各行をcountryテーブルに挿入する行に変換する
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+
+    Yields
+    ------
+    dict
+    """
+
+    columns = ['name', 'landmass', 'zone', 'area', 'population', 'language', 'religion']
+    keys = ['name', 'landmass_id', 'zone_id', 'area', 'population', 'language_id', 'religion_id']
+    for row in df[columns].itertuples(index=False, name=None):
+        yield dict(zip(keys, row))
+
+
+def iter_synthetic_country_rows(df: pd.DataFrame, num_rows: int, seed: Optional[int] = None) -> Iterator[dict]:
+    """dfの国をもとに、countryテーブルに挿入する架空の国の行を生成する
+
+    dfから無作為に選んだ国の州、象限、言語、宗教を引き継ぐため、各idの分布や組み合わせは
+    元のデータと同程度になる。面積と人口は、元の国の値に対数正規分布に従う係数を掛けて生成する。
+    insert_batch_size件ずつまとめて生成するため、num_rowsによらずメモリ使用量は一定となる。
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        load_csvで取得したデータ
+    num_rows : int
+        生成する行数
+    seed : int, optional
+        乱数のシード値
+
+    Yields
+    ------
+    dict
+    """
+
+    assert num_rows >= 0
+
+    rng = np.random.default_rng(seed)
+
+    names = df['name'].to_numpy()
+    landmass = df['landmass'].to_numpy()
+    zone = df['zone'].to_numpy()
+    area = df['area'].to_numpy()
+    population = df['population'].to_numpy()
+    language = df['language'].to_numpy()
+    religion = df['religion'].to_numpy()
+
+    for offset in range(0, num_rows, insert_batch_size):
+        size = min(insert_batch_size, num_rows - offset)
+        source = rng.integers(0, len(df), size)
+
+        # 国名は主キーのため、元の国名に通し番号を付けて一意にする
+        chunk_names = [f'{name} {offset + i + 1}' for i, name in enumerate(names[source])]
+        chunk_area = np.rint(area[source] * rng.lognormal(0, 0.5, size)).astype(np.int64)
+        chunk_population = np.rint(population[source] * rng.lognormal(0, 0.5, size)).astype(np.int64)
+
+        columns = zip(
+            chunk_names,
+            landmass[source].tolist(),
+            zone[source].tolist(),
+            chunk_area.tolist(),
+            chunk_population.tolist(),
+            language[source].tolist(),
+            religion[source].tolist()
+        )
+        keys = ['name', 'landmass_id', 'zone_id', 'area', 'population', 'language_id', 'religion_id']
+        for row in columns:
+            yield dict(zip(keys, row))
+
+
+def insert_rows(connection, table, rows: Iterable[dict]) -> int:
+    """行をinsert_batch_size件ずつexecutemanyでテーブルに挿入する
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.base.Connection
+    table : sqlalchemy.schema.Table
+    rows : Iterable[dict]
+
+    Returns
+    -------
+    int
+        挿入した行数
     """
 
-    if not db_path.parent.exists():
-        db_path.parent.mkdir()
+    statement = table.insert()
+    num_rows = 0
+    rows = iter(rows)
+    for batch in iter(lambda: list(islice(rows, insert_batch_size)), []):
+        connection.execute(statement, batch)
+        num_rows += len(batch)
+
+    return num_rows
+
+
+def compute_input_hash(num_synthetic_rows: int, seed: Optional[int]) -> str:
+    """DBの内容を決める入力のハッシュ値を計算する
+
+    入力は、csvファイル、スキーマとデプロイ処理のソースコード、架空の国の生成パラメータとする。
+
+    Parameters
+    ----------
+    num_synthetic_rows : int
+        架空の国の数
+    seed : int or None
+        架空の国を生成する乱数のシード値
+
+    Returns
+    -------
+    str
+        SHA-256の16進数表記
+    """
 
-    if db_path.exists():
-        db_path.unlink()
+    digest = hashlib.sha256()
+    for path in [csv_path, Path(database.__file__), Path(__file__)]:
+        digest.update(path.read_bytes())
+    digest.update(f'{num_synthetic_rows},{seed}'.encode())
 
-    engine = create_engine(f'sqlite:///{db_path}', echo=True)
-    database.create_db(engine)
+    return digest.hexdigest()
+
+
+def read_input_hash(path: Path) -> Optional[str]:
+    """デプロイ済みのDBに記録された入力のハッシュ値を取得する
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        SQLite DBのパス
+
+    Returns
+    -------
+    str or None
+        DBが存在しない、またはハッシュ値が記録されていない場合はNone
+    """
+
+    if not path.exists():
+        return None
+
+    connection = sqlite3.connect(f'{path.resolve().as_uri()}?mode=ro', uri=True)
+    try:
+        row = connection.execute('SELECT input_hash FROM deploy_info').fetchone()
+    except sqlite3.DatabaseError:
+        row = None
+    finally:
+        connection.close()
+
+    return row[0] if row else None
+
+
+def load_db(engine, country_rows: Iterable[dict]):
+    """テーブルを作成し、1つのトランザクションで全ての行を挿入する
+
+    挿入中はジャーナルとディスクへの同期を無効にする。デプロイ中のDBファイルは
+    失敗しても作り直せばよいため、クラッシュ時の安全性より速度を優先する。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine
+    country_rows : Iterable[dict]
+        countryテーブルに挿入する行
+    """
+
+    timings: Dict[str, float] = {}
+
+    with engine.connect() as connection:
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+
+        with connection.begin():
+            with measure_time(timings, 'create tables'):
+                database.create_tables(connection)
+
+            with measure_time(timings, 'insert country'):
+                num_countries = insert_rows(connection, database.Country.__table__, country_rows)
+
+            with measure_time(timings, 'insert others'):
+                insert_rows(connection, database.Landmass.__table__, landmasses)
+                insert_rows(connection, database.Zone.__table__, zones)
+                insert_rows(connection, database.Language.__table__, languages)
+                insert_rows(connection, database.Religion.__table__, religions)
+
+            with measure_time(timings, 'create indexes'):
+                database.create_indexes(connection)
+
+            with measure_time(timings, 'create search index'):
+                database.create_search_index(connection)
+
+            with measure_time(timings, 'create rollups'):
+                database.create_rollups(connection)
+
+        with measure_time(timings, 'analyze'):
+            connection.execute('ANALYZE')
+
+    print(f'{num_countries}件の国をデプロイしました')
+    print_timings(timings)
+
+
+def main(
+    num_synthetic_rows: int = 0, seed: Optional[int] = None, force: bool = False, path: Path = db_path
+):
+    """.data/db.sqliteにSQLite DBをデプロイする
+
+    DBテーブルを作成し、dfからデータを生成して各テーブルに挿入する。
+    入力のハッシュ値がデプロイ済みのDBと一致する場合は、何もしない。
+
+    Parameters
+    ----------
+    num_synthetic_rows : int, optional
+        元のデータに加えて生成する架空の国の数。デフォルト値は0
+    seed : int, optional
+        架空の国を生成する乱数のシード値
+    force : bool, optional
+        Trueの場合、入力に変更がなくてもDBを作り直す。デフォルト値はFalse
+    path : pathlib.Path, optional
+        デプロイ先のパス。デフォルト値は.data/db.sqlite
+    """
+
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True)
 
     df = load_csv()
 
-    countries = [
-        database.Country(
-            name=r.name,
-            landmass_id=r.landmass,
-            zone_id=r.zone,
-            area=r.area,
-            population=r.population,
-            language_id=r.language,
-            religion_id=r.religion
+    input_hash = compute_input_hash(num_synthetic_rows, seed)
+    if not force and read_input_hash(path) == input_hash:
+        print('入力に変更がないため、デプロイをスキップしました')
+        return
+
+    # 読み込み中のアプリが作成途中のDBを参照しないように、一時ファイルにDBを作成してから置き換える。
+    # os.replaceによる置き換えはアトミックに行われ、置き換え前に開かれた接続は古いDBを参照し続ける。
+    fd, tmp_name = tempfile.mkstemp(prefix='.db-', suffix='.sqlite', dir=path.parent)
+    os.close(fd)
+    tmp_path = Path(tmp_name)
+    try:
+        engine = create_engine(f'sqlite:///{tmp_path}')
+        country_rows = chain(
+            iter_country_rows(df),
+            iter_synthetic_country_rows(df, num_synthetic_rows, seed)
         )
-        for r in df.itertuples()
-    ]
-    landmasses = [
-        database.Landmass(id=1, name='N.America'),
-        database.Landmass(id=2, name='S.America'),
-        database.Landmass(id=3, name='Europe'),
-        database.Landmass(id=4, name='Africa'),
-        database.Landmass(id=5, name='Asia'),
-        database.Landmass(id=6, name='Oceania'),
-    ]
-    zones = [
-        database.Zone(id=1, quadrant='NE'),
-        database.Zone(id=2, quadrant='SE'),
-        database.Zone(id=3, quadrant='SW'),
-        database.Zone(id=4, quadrant='NW')
-    ]
-    languages = [
-        database.Language(id=1, name='English'),
-        database.Language(id=2, name='Spanish'),
-        database.Language(id=3, name='French'),
-        database.Language(id=4, name='German'),
-        database.Language(id=5, name='Slavic'),
-        database.Language(id=6, name='Other Indo-European'),
-        database.Language(id=7, name='Chinese'),
-        database.Language(id=8, name='Arabic'),
-        database.Language(id=9, name='Japanese/Turkish/Finnish/Magyar'),
-        database.Language(id=10, name='Others'),
-    ]
-    religions = [
-        database.Religion(id=0, name='Catholic'),
-        database.Religion(id=1, name='Other Christian'),
-        database.Religion(id=2, name='Muslim'),
-        database.Religion(id=3, name='Buddhist'),
-        database.Religion(id=4, name='Hindu'),
-        database.Religion(id=5, name='Ethnic'),
-        database.Religion(id=6, name='Marxist'),
-        database.Religion(id=7, name='Others')
-    ]
+        load_db(engine, country_rows)
+
+        with engine.begin() as connection:
+            connection.execute('CREATE TABLE deploy_info (input_hash TEXT NOT NULL)')
+            connection.execute('INSERT INTO deploy_info (input_hash) VALUES (?)', (input_hash,))
+        engine.dispose()
+
+        # mkstempで作成したファイルは所有者のみが読み書きできるため、通常のファイルと同じ権限にする
+        umask = os.umask(0)
+        os.umask(umask)
+        tmp_path.chmod(0o666 & ~umask)
 
-    with session_scope(engine) as session:
-        session.add_all(countries)
-        session.add_all(landmasses)
-        session.add_all(zones)
-        session.add_all(languages)
-        session.add_all(religions)
+        os.replace(tmp_path, path)
+
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='SQLite DBをデプロイする')
+    parser.add_argument(
+        '--synthetic-rows', type=int, default=0,
+        help='元のデータに加えて生成する架空の国の数'
+    )
+    parser.add_argument('--seed', type=int, default=None, help='架空の国を生成する乱数のシード値')
+    parser.add_argument('--force', action='store_true', help='入力に変更がなくてもDBを作り直す')
+    args = parser.parse_args()
+
+    main(args.synthetic_rows, args.seed, args.force)
@@ -0,0 +1,175 @@
+import csv
+import io
+from typing import Iterator, List, Sequence, Set
+
+import pyarrow as pa
+
+from query import route_query, time_limited_connection
+
+
+def iter_csv(engine, sql_text: str, chunk_size: int, time_budget: float) -> Iterator[str]:
+    """クエリ結果をCSV形式の文字列としてchunk_size行ずつ出力する
+
+    カーソルからfetchmanyで取得した行をそのまま書き出すため、メモリ使用量は結果の行数によらず、
+    chunk_sizeで決まる。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine
+    sql_text : str
+    chunk_size : int
+        1回に取得して出力する行数
+    time_budget : float
+        実行時間の上限(秒)
+
+    Yields
+    ------
+    str
+        1行目はヘッダ行、以降はchunk_size行ずつのCSV
+    """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush() -> str:
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    with time_limited_connection(engine, time_budget) as connection:
+        sql, _ = route_query(connection, sql_text)
+        result = connection.execute(sql)
+        if not result.returns_rows:
+            return
+
+        writer.writerow(result.keys())
+        yield flush()
+
+        for chunk in iter(lambda: result.fetchmany(chunk_size), []):
+            writer.writerows(chunk)
+            yield flush()
+
+
+def scan_value_types(result, chunk_size: int) -> List[Set[type]]:
+    """クエリ結果の全ての行を読み、列ごとに値のPythonの型を集める
+
+    Parameters
+    ----------
+    result : sqlalchemy.engine.ResultProxy
+    chunk_size : int
+        1回に取得する行数
+
+    Returns
+    -------
+    List[Set[type]]
+        列ごとの値の型の集合。Noneの型は含めない
+    """
+
+    value_types: List[Set[type]] = [set() for _ in result.keys()]
+    for chunk in iter(lambda: result.fetchmany(chunk_size), []):
+        for types, values in zip(value_types, zip(*chunk)):
+            types.update(type(v) for v in values if v is not None)
+    return value_types
+
+
+def arrow_type(value_types: Set[type]) -> pa.DataType:
+    """列の値の型の集合から、全ての値を変換せずに格納できるArrowの型を決める
+
+    整数と実数が混在する列は実数型、それ以外の型が混在する列は文字列型とする。
+    値が全て欠損している列は文字列型とする。
+
+    Parameters
+    ----------
+    value_types : Set[type]
+        scan_value_typesで集めた、列の値の型の集合
+
+    Returns
+    -------
+    pyarrow.DataType
+    """
+
+    if value_types == {int}:
+        return pa.int64()
+    elif value_types == {float} or value_types == {int, float}:
+        return pa.float64()
+    elif value_types == {bytes}:
+        return pa.binary()
+    else:
+        return pa.string()
+
+
+def to_record_batch(rows: List[tuple], schema: pa.Schema) -> pa.RecordBatch:
+    """行のリストをArrowのRecordBatchに変換する
+
+    Parameters
+    ----------
+    rows : List[tuple]
+    schema : pyarrow.Schema
+        全ての値を格納できる型を指定したスキーマ
+
+    Returns
+    -------
+    pyarrow.RecordBatch
+    """
+
+    values: List[Sequence] = list(zip(*rows)) if rows else [() for _ in schema]
+
+    arrays = []
+    for v, field in zip(values, schema):
+        # SQLiteの列は行ごとに型が異なり得るため、文字列型の列には値を文字列に変換して格納する
+        if pa.types.is_string(field.type):
+            v = [None if x is None else str(x) for x in v]
+        arrays.append(pa.array(v, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_arrow(engine, sql_text: str, chunk_size: int, time_budget: float) -> Iterator[bytes]:
+    """クエリ結果をArrow IPCのストリーム形式でchunk_size行ずつ出力する
+
+    ストリームの途中でスキーマは変えられないため、出力を始める前にクエリを一度最後まで実行して、
+    全ての行の値から列の型を決める。その後、クエリを再度実行して出力する。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine
+    sql_text : str
+    chunk_size : int
+        1回に取得して出力する行数
+    time_budget : float
+        実行時間の上限(秒)
+
+    Yields
+    ------
+    bytes
+    """
+
+    buffer = io.BytesIO()
+
+    def flush() -> bytes:
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    with time_limited_connection(engine, time_budget) as connection:
+        sql, _ = route_query(connection, sql_text)
+        result = connection.execute(sql)
+        if not result.returns_rows:
+            return
+
+        columns = list(result.keys())
+        value_types = scan_value_types(result, chunk_size)
+        result.close()
+        schema = pa.schema([(c, arrow_type(t)) for c, t in zip(columns, value_types)])
+
+        result = connection.execute(sql)
+        writer = pa.ipc.new_stream(buffer, schema)
+        yield flush()
+
+        for chunk in iter(lambda: result.fetchmany(chunk_size), []):
+            writer.write_batch(to_record_batch(chunk, schema))
+            yield flush()
+
+        writer.close()
+        yield flush()
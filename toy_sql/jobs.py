@@ -0,0 +1,337 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Set, Tuple
+import uuid
+
+import numpy as np
+
+from query import QueryCancelled
+
+
+class QueryRejected(Exception):
+    """実行できるクエリ数に空きがないため、クエリを受け付けなかった場合に送出される例外"""
+
+
+class Job(object):
+    """バックグラウンドで実行するクエリのジョブ
+
+    Parameters
+    ----------
+    session_id : str
+        ジョブを投入したセッションのid
+
+    Attributes
+    ----------
+    id_ : str
+        ジョブのid
+    status : str
+        pending, running, done, failed, cancelledのいずれか
+    rows_fetched : int
+        これまでに取得した行数
+    result : Any
+        statusがdoneの場合の実行結果
+    error : Exception or None
+        statusがfailedの場合に発生した例外
+    cancel_event : threading.Event
+        セットされると、実行中のクエリが中断される
+    """
+
+    def __init__(self, session_id: str):
+        self.id_ = uuid.uuid4().hex
+        self.session_id = session_id
+        self.status = 'pending'
+        self.rows_fetched = 0
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+        self.cancel_event = threading.Event()
+
+        self.submitted_at = time.perf_counter()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        """実行開始からの経過時間(秒)。実行前は0を返す"""
+
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.perf_counter()
+        return end - self.started_at
+
+    @property
+    def wait(self) -> float:
+        """投入されてから実行が開始されるまでの待ち時間(秒)。実行前は現在までの待ち時間を返す"""
+
+        end = self.started_at if self.started_at is not None else time.perf_counter()
+        return end - self.submitted_at
+
+    @property
+    def finished(self) -> bool:
+        """ジョブが終了している場合にTrue"""
+
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def report_progress(self, rows_fetched: int):
+        """取得済みの行数を更新する
+
+        Parameters
+        ----------
+        rows_fetched : int
+        """
+
+        self.rows_fetched = rows_fetched
+
+
+class JobManager(object):
+    """クエリのジョブをスレッドプールで実行し、状態を保持するクラス
+
+    同時に実行するジョブ数はmax_workersまでに制限し、1つのセッションが同時に実行できるジョブは1つまでとする。
+    実行できないジョブは待ち行列に入れ、セッションごとに投入順に実行する。
+    待ち行列にはセッションごとに最新のジョブだけを保持するため、あるセッションがジョブを繰り返し投入しても、
+    他のセッションの待ち順は後ろにならない。
+
+    同じセッションから新しいジョブが投入された場合は、そのセッションの実行中または実行待ちのジョブをキャンセルする。
+
+    ページ表示や実行計画のように、リクエストを処理するスレッドで直接実行するクエリはslotで実行枠を取得する。
+    直接実行するクエリもジョブと同じmax_workersの実行枠を使い、1つのセッションが直接実行できるクエリは
+    max_session_slotsまでとする。実行枠に空きがない場合は待たずにQueryRejectedを送出する。
+
+    Parameters
+    ----------
+    max_workers : int
+        同時に実行するジョブと直接実行するクエリの合計数の上限
+    max_session_slots : int, optional
+        1つのセッションが同時に直接実行できるクエリ数の上限。デフォルト値は2
+    retention : float, optional
+        終了したジョブの状態を保持する時間(秒)。デフォルト値は600
+    wait_samples : int, optional
+        待ち時間の統計に使う、直近に実行を開始したジョブの数。デフォルト値は1000
+    """
+
+    def __init__(self, max_workers: int, max_session_slots: int = 2, retention: float = 600, wait_samples: int = 1000):
+        self.max_workers = max_workers
+        self.max_session_slots = max_session_slots
+        self.retention = retention
+        self.admitted = 0
+        self.rejected = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='query-job')
+        self._jobs: Dict[str, Job] = {}
+        self._latest_jobs: Dict[str, str] = {}
+        # 実行待ちのジョブ。キーはセッションのidで、投入順に並ぶ
+        self._queue: 'OrderedDict[str, Tuple[Job, Callable[[Job], Any]]]' = OrderedDict()
+        # ジョブを実行中のセッションのid
+        self._running_sessions: Set[str] = set()
+        # 直接実行しているクエリ数。キーはセッションのid
+        self._slots: Dict[str, int] = {}
+        self._waits: Deque[float] = deque(maxlen=wait_samples)
+        self._lock = threading.Lock()
+
+    def submit(self, session_id: str, run: Callable[[Job], Any]) -> Job:
+        """ジョブを投入する
+
+        実行できるジョブ数に空きがない場合でも待たずに返り、ジョブは待ち行列で実行を待つ。
+
+        Parameters
+        ----------
+        session_id : str
+            ジョブを投入したセッションのid
+        run : Callable[[Job], Any]
+            ジョブを受け取って実行し、結果を返す関数。
+            ジョブのcancel_eventがセットされたらQueryCancelledを送出して中断する。
+
+        Returns
+        -------
+        Job
+        """
+
+        job = Job(session_id)
+        with self._lock:
+            self._prune()
+
+            stale_job_id = self._latest_jobs.get(session_id)
+            if stale_job_id in self._jobs:
+                self._jobs[stale_job_id].cancel_event.set()
+
+            # 実行待ちのジョブは、待ち順を引き継いで新しいジョブに置き換える
+            if session_id in self._queue:
+                stale_job, _ = self._queue[session_id]
+                stale_job.status = 'cancelled'
+                stale_job.finished_at = time.perf_counter()
+
+            self._queue[session_id] = (job, run)
+            self._jobs[job.id_] = job
+            self._latest_jobs[session_id] = job.id_
+
+            self._dispatch()
+
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """ジョブを取得する
+
+        Parameters
+        ----------
+        job_id : str
+
+        Returns
+        -------
+        Job or None
+            ジョブが存在しない、または保持期間を過ぎて破棄された場合はNone
+        """
+
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def position(self, job: Job) -> Optional[int]:
+        """実行待ちのジョブの待ち順を取得する
+
+        Parameters
+        ----------
+        job : Job
+
+        Returns
+        -------
+        int or None
+            1始まりの待ち順。実行待ちでない場合はNone
+        """
+
+        with self._lock:
+            for position, (queued_job, _) in enumerate(self._queue.values(), start=1):
+                if queued_job is job:
+                    return position
+
+        return None
+
+    @contextmanager
+    def slot(self, session_id: str) -> Iterator[None]:
+        """リクエストを処理するスレッドでクエリを直接実行するための実行枠を取得する
+
+        実行枠は、withブロックを抜けると解放される。
+
+        Parameters
+        ----------
+        session_id : str
+            クエリを実行するセッションのid
+
+        Raises
+        ------
+        QueryRejected
+            実行枠に空きがない場合、またはセッションが直接実行しているクエリ数が上限に達している場合
+        """
+
+        with self._lock:
+            if self._running_count() >= self.max_workers or self._slots.get(session_id, 0) >= self.max_session_slots:
+                self.rejected += 1
+                raise QueryRejected()
+
+            self._slots[session_id] = self._slots.get(session_id, 0) + 1
+            self.admitted += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._slots[session_id] -= 1
+                if not self._slots[session_id]:
+                    del self._slots[session_id]
+                self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        """待ち行列の統計情報を出力する
+
+        Returns
+        -------
+        dict[str, Any]
+        """
+
+        with self._lock:
+            waits = np.array(self._waits)
+            queued_waits = [job.wait for job, _ in self._queue.values()]
+            return {
+                'running': len(self._running_sessions),
+                'running_slots': sum(self._slots.values()),
+                'queued': len(self._queue),
+                'max_workers': self.max_workers,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'oldest_queued_wait': max(queued_waits) if queued_waits else None,
+                'wait_mean': float(waits.mean()) if waits.size else None,
+                'wait_p50': float(np.percentile(waits, 50)) if waits.size else None,
+                'wait_p95': float(np.percentile(waits, 95)) if waits.size else None,
+                'wait_max': float(waits.max()) if waits.size else None
+            }
+
+    def shutdown(self):
+        """全てのジョブをキャンセルし、スレッドプールを終了する"""
+
+        with self._lock:
+            for job in self._jobs.values():
+                job.cancel_event.set()
+
+            for job, _ in self._queue.values():
+                job.status = 'cancelled'
+                job.finished_at = time.perf_counter()
+            self._queue.clear()
+
+        self._executor.shutdown(wait=False)
+
+    def _dispatch(self):
+        # 実行中のジョブがないセッションのジョブを、投入順に実行できるジョブ数まで開始する。呼び出し側でロックを取得しておく
+        for session_id in list(self._queue):
+            if self._running_count() >= self.max_workers:
+                break
+            if session_id in self._running_sessions:
+                continue
+
+            job, run = self._queue.pop(session_id)
+            self._running_sessions.add(session_id)
+            self._waits.append(job.wait)
+            self.admitted += 1
+            self._executor.submit(self._run, job, run)
+
+    def _running_count(self) -> int:
+        # 実行中のジョブと、直接実行しているクエリの合計数。呼び出し側でロックを取得しておく
+        return len(self._running_sessions) + sum(self._slots.values())
+
+    def _run(self, job: Job, run: Callable[[Job], Any]):
+        try:
+            self._execute(job, run)
+        finally:
+            with self._lock:
+                self._running_sessions.discard(job.session_id)
+                self._dispatch()
+
+    def _execute(self, job: Job, run: Callable[[Job], Any]):
+        if job.cancel_event.is_set():
+            job.status = 'cancelled'
+            job.finished_at = time.perf_counter()
+            return
+
+        job.status = 'running'
+        job.started_at = time.perf_counter()
+        try:
+            job.result = run(job)
+            job.status = 'done'
+        except QueryCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            job.error = e
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.perf_counter()
+
+    def _prune(self):
+        # 保持期間を過ぎた終了済みのジョブを破棄する。呼び出し側でロックを取得しておく
+        now = time.perf_counter()
+        expired_job_ids = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and now - job.finished_at > self.retention
+        ]
+        for job_id in expired_job_ids:
+            job = self._jobs.pop(job_id)
+            if self._latest_jobs.get(job.session_id) == job_id:
+                del self._latest_jobs[job.session_id]
@@ -0,0 +1,670 @@
+from contextlib import ExitStack, contextmanager
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from database import Country, rollup_dimensions, rollup_table_name, search_index_name
+from timing import measure_time
+
+
+# SQL文中の文字列リテラルと引用符付きの識別子にマッチする正規表現
+quoted_pattern = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\])""")
+# SQL文中のコメントと、引用符で囲まれた部分にマッチする正規表現
+# 引用符の内側の「--」や「/*」をコメントとみなさないように、先に始まる方にマッチさせる
+# 閉じられていないブロックコメントは、SQLiteと同じくSQL文の終わりまでをコメントとする
+comment_pattern = re.compile(r"""(?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))|""" + quoted_pattern.pattern, re.DOTALL)
+# 検索インデックスで処理できる「国名 LIKE '%文字列%'」の条件にマッチする正規表現
+# trigramインデックスは3文字以上の文字列でなければ使われないため、3文字未満の場合はマッチさせない
+search_like_pattern = re.compile(
+    r"""(?P<column>\b(?:(?P<table>\w+)\.)?name)\s+LIKE\s+"""
+    r"""(?P<literal>'%[^%_'"]{3,}%'|"%[^%_'"]{3,}%")(?!\s*ESCAPE\b)""",
+    re.IGNORECASE
+)
+
+# 検索インデックスを使うように書き換えられる、countryテーブルだけを参照するSELECT文にマッチする正規表現
+# normalize_sqlで正規化し、リテラルを取り除いたSQL文に適用する
+single_country_pattern = re.compile(r'select .+? from country(?: (?:as )?(?P<alias>\w+))? where .+')
+
+# 集計テーブルで処理できる、countryテーブルを分類ごとに集計するSELECT文にマッチする正規表現
+# normalize_sqlで正規化したSQL文に適用する
+rollup_query_pattern = re.compile(
+    r'select (?P<items>.+?) from country(?: (?:as )?(?P<alias>\w+))?'
+    r'(?: (?:inner )?join (?P<dimension>\w+)(?: (?:as )?(?P<dimension_alias>\w+))?'
+    r' on (?P<left>\w+\.\w+) ?= ?(?P<right>\w+\.\w+))?'
+    r' group by (?P<rest>.+)'
+)
+# 集計テーブルの列から計算できる集計関数の呼び出しにマッチする正規表現
+aggregate_pattern = re.compile(
+    r'\b(?P<function>count|sum|avg|min|max)\s*\(\s*(?:(?P<table>\w+)\s*\.\s*)?(?P<column>\*|\w+)\s*\)',
+    re.IGNORECASE
+)
+# 列の参照にマッチする正規表現
+column_reference_pattern = re.compile(r'\b(?:(?P<table>\w+)\s*\.\s*)?(?P<column>\*|\w+)|\*')
+# countryテーブルの列名。rowidなどの別名を含む
+country_columns = {column.name for column in Country.__table__.columns} | {'rowid', 'oid', '_rowid_'}
+# 集計テーブルの列で集計できるcountryテーブルの列
+rollup_value_columns = ('area', 'population')
+
+# プログレスハンドラを呼び出す間隔(SQLite仮想マシンの命令数)
+progress_interval = 10000
+
+# run_queryで1回のfetchmanyで取得する行数
+fetch_chunk_size = 1000
+
+
+class QueryTimeout(Exception):
+    """クエリの実行時間が上限を超えて中断された場合に送出される例外
+
+    Parameters
+    ----------
+    elapsed : float
+        中断されるまでの実行時間(秒)
+    """
+
+    def __init__(self, elapsed: float):
+        super().__init__(f'query interrupted after {elapsed:.2f} seconds')
+        self.elapsed = elapsed
+
+
+class QueryCancelled(Exception):
+    """クエリがキャンセルされて中断された場合に送出される例外"""
+
+
+class QueryResult(NamedTuple):
+    """クエリの実行結果
+
+    Attributes
+    ----------
+    columns : List[str]
+        列名のリスト
+    rows : List[tuple]
+        行のリスト
+    truncated : bool
+        行数の上限を超えたため、結果が打ち切られた場合にTrue
+    elapsed : float
+        実行時間(秒)
+    timings : Dict[str, float]
+        処理の段階ごとの実行時間(秒)。connect、execute、fetchの各段階を含む
+    rollup : str, optional
+        集計テーブルから結果を取得した場合は、その集計テーブルのテーブル名
+    """
+
+    columns: List[str]
+    rows: List[tuple]
+    truncated: bool
+    elapsed: float
+    timings: Dict[str, float]
+    rollup: Optional[str] = None
+
+
+class QueryPlan(NamedTuple):
+    """クエリの実行計画と実測した実行時間
+
+    Attributes
+    ----------
+    lines : List[str]
+        EXPLAIN QUERY PLANの出力を木構造に沿って字下げした行のリスト
+    elapsed : float
+        クエリを最後の行まで実行するのにかかった時間(秒)
+    num_rows : int
+        クエリ結果の行数
+    interrupted : bool
+        実行時間が上限を超えて中断された場合にTrue
+    rollup : str, optional
+        集計テーブルを使うように書き換えたクエリの実行計画の場合は、その集計テーブルのテーブル名
+    """
+
+    lines: List[str]
+    elapsed: float
+    num_rows: int
+    interrupted: bool
+    rollup: Optional[str] = None
+
+
+def strip_sql(sql_text: str) -> str:
+    """SQL文の前後の空白と末尾のセミコロンを取り除く
+
+    Parameters
+    ----------
+    sql_text : str
+
+    Returns
+    -------
+    str
+    """
+
+    return sql_text.strip().rstrip(';').rstrip()
+
+
+def strip_comments(sql_text: str) -> str:
+    """SQL文から、引用符の外側のコメントを取り除く
+
+    コメントは1つの空白に置き換えるため、行コメントの後の語が前の語と連結されることはない。
+
+    Parameters
+    ----------
+    sql_text : str
+
+    Returns
+    -------
+    str
+    """
+
+    return comment_pattern.sub(lambda m: ' ' if m.group('comment') is not None else m.group(), sql_text)
+
+
+def normalize_sql(sql_text: str) -> str:
+    """キャッシュのキーとして使うために、SQL文を正規化する
+
+    コメントを取り除いてから、引用符の外側だけを小文字にし、連続する空白を1つの空白にまとめる。
+    行コメントは改行で終わるため、空白をまとめる前に取り除かないと、コメントの後の部分がコメントに含まれるSQL文と
+    区別できなくなる。
+    引用符の内側は大文字と小文字で意味が変わり得るため、そのまま残す。
+
+    Parameters
+    ----------
+    sql_text : str
+
+    Returns
+    -------
+    str
+    """
+
+    # re.splitの結果は、偶数番目が引用符の外側、奇数番目が引用符で囲まれた部分となる
+    parts = quoted_pattern.split(strip_sql(strip_comments(sql_text)))
+    normalized_parts = [
+        part if i % 2 else re.sub(r'\s+', ' ', part).lower()
+        for i, part in enumerate(parts)
+    ]
+    return ''.join(normalized_parts)
+
+
+def route_search_index(connection, sql_text: str) -> str:
+    """国名の部分一致検索を、検索インデックスを使うクエリに書き換える
+
+    countryテーブルだけを参照するSELECT文で、WHERE句に`name LIKE '%文字列%'`を1つだけ含む場合に、
+    その条件を検索インデックスのFTS5テーブルに対するサブクエリに置き換える。
+    文字列は3文字以上のASCII文字で、%と_を含まないものに限る。
+    検索インデックスがない場合や、条件を満たさない場合は、SQL文をそのまま返す。
+
+    例えば、
+        SELECT name FROM country WHERE name LIKE "%land%"
+    は、次のように書き換えられる。
+        SELECT name FROM country WHERE rowid IN (SELECT rowid FROM country_name_fts WHERE name LIKE "%land%")
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.base.Connection
+    sql_text : str
+
+    Returns
+    -------
+    str
+    """
+
+    sql_text = strip_sql(sql_text)
+
+    # 構造を判定するときは、リテラルの中身に影響されないように空のリテラルに置き換える
+    skeleton = quoted_pattern.sub("''", normalize_sql(sql_text))
+    structure = single_country_pattern.fullmatch(skeleton)
+    if structure is None or skeleton.count(' from ') != 1:
+        return sql_text
+
+    quoted_spans = [m.span() for m in quoted_pattern.finditer(sql_text)]
+    matches = [
+        m for m in search_like_pattern.finditer(sql_text)
+        if not any(start <= m.start() < end for start, end in quoted_spans)
+    ]
+    if len(matches) != 1:
+        return sql_text
+
+    match = matches[0]
+    table = match.group('table')
+    if table is not None and table.lower() not in ('country', structure.group('alias')):
+        return sql_text
+    if not match.group('literal').isascii():
+        return sql_text
+
+    if sqlite3.sqlite_version_info < (3, 34, 0) or not has_table(connection, search_index_name):
+        return sql_text
+
+    rowid = 'rowid' if table is None else f'{table}.rowid'
+    subquery = f'{rowid} IN (SELECT rowid FROM {search_index_name} WHERE name LIKE {match.group("literal")})'
+    return sql_text[:match.start()] + subquery + sql_text[match.end():]
+
+
+def route_rollup(connection, sql_text: str) -> Tuple[str, Optional[str]]:
+    """countryテーブルを分類ごとに集計するクエリを、集計テーブルを使うクエリに書き換える
+
+    countryテーブル(と、1つの分類のテーブルとの結合)を分類のidでGROUP BYするSELECT文のうち、
+    集計関数がCOUNT(*か国名、面積、人口が対象)か、SUM、AVG、MIN、MAX(面積、人口が対象)の場合に、
+    countryテーブルを集計テーブルに置き換える。
+    WHERE句やHAVING句、サブクエリ、引用符を含む場合や、集計テーブルがない場合は、SQL文をそのまま返す。
+
+    例えば、
+        SELECT r.name, COUNT(c.name) AS count FROM country c JOIN religion r ON c.religion_id = r.id GROUP BY r.name
+    は、次のように書き換えられる。
+        SELECT r.name, SUM(c.country_count) AS count FROM rollup_country_by_religion c JOIN religion r ON c.religion_id = r.id GROUP BY r.name
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.base.Connection
+    sql_text : str
+
+    Returns
+    -------
+    sql_text : str
+        書き換えたSQL文
+    rollup : str or None
+        集計テーブルを使うように書き換えた場合は、集計テーブルのテーブル名
+    """
+
+    sql_text = strip_sql(sql_text)
+
+    # 列名の判定を単純にするため、引用符を含むSQL文は対象としない
+    skeleton = normalize_sql(sql_text)
+    if quoted_pattern.search(skeleton) is not None:
+        return sql_text, None
+
+    structure = rollup_query_pattern.fullmatch(skeleton)
+    if structure is None:
+        return sql_text, None
+    if any(skeleton.count(keyword) != 1 for keyword in ('select ', ' from ', ' group by ')):
+        return sql_text, None
+    if any(keyword in skeleton for keyword in (' where ', ' having ', ' union ', ' intersect ', ' except ')):
+        return sql_text, None
+
+    dimension = structure.group('dimension')
+    if skeleton.count(' join ') != (0 if dimension is None else 1):
+        return sql_text, None
+    if dimension is not None and dimension not in rollup_dimensions:
+        return sql_text, None
+
+    keywords = {'join', 'inner', 'group', 'on'}
+    alias = structure.group('alias')
+    dimension_alias = structure.group('dimension_alias')
+    if alias in keywords or dimension_alias in keywords:
+        return sql_text, None
+    country_names = {alias or 'country'}
+
+    # 集計関数の呼び出しを取り除いた残りで、countryテーブルの列が分類のidだけであることを確かめる
+    aggregates = list(aggregate_pattern.finditer(skeleton))
+    for match in aggregates:
+        if match.group('table') is not None and match.group('table') not in country_names:
+            return sql_text, None
+        # 集計テーブルには国の数と、面積と人口の集計値しかないため、*と国名はCOUNTの対象としてだけ扱える
+        if match.group('function') == 'count':
+            if match.group('column') not in ('*', 'name') + rollup_value_columns:
+                return sql_text, None
+        elif match.group('column') not in rollup_value_columns:
+            return sql_text, None
+        if match.group('column') == '*' and match.group('table') is not None:
+            return sql_text, None
+    remainder = aggregate_pattern.sub(' ', skeleton)
+    if '(' in remainder:
+        return sql_text, None
+
+    if dimension is not None:
+        dimension_names = {dimension_alias or dimension}
+        on_columns = {structure.group('left'), structure.group('right')}
+        if on_columns != {f'{name}.{dimension}_id' for name in country_names} | {f'{name}.id' for name in dimension_names}:
+            return sql_text, None
+
+    referenced = set()
+    for match in column_reference_pattern.finditer(remainder):
+        table, column = match.group('table'), match.group('column')
+        if column is None or column == '*':
+            return sql_text, None
+        if table is None and column not in country_columns:
+            continue
+        if table is not None and table not in country_names:
+            continue
+        if not column.endswith('_id') or column[:-len('_id')] not in rollup_dimensions:
+            return sql_text, None
+        referenced.add(column[:-len('_id')])
+
+    if dimension is not None:
+        referenced.add(dimension)
+    if len(referenced) != 1:
+        return sql_text, None
+    dimension = referenced.pop()
+
+    rollup = rollup_table_name(dimension)
+    if not has_table(connection, rollup):
+        return sql_text, None
+
+    # SELECT句の集計関数は、列名が変わらないように元の式を別名にする
+    select_match = re.search(r'\bselect\b', sql_text, re.IGNORECASE)
+    from_match = re.search(r'\bfrom\s+country\b', sql_text, re.IGNORECASE)
+    if select_match is None or from_match is None:
+        return sql_text, None
+    items = []
+    for item in sql_text[select_match.end():from_match.start()].split(','):
+        if aggregate_pattern.search(item) is None:
+            items.append(item)
+        elif aggregate_pattern.fullmatch(item.strip()) is not None:
+            items.append(f'{aggregate_pattern.sub(rewrite_aggregate, item.rstrip())} AS "{item.strip()}" ')
+        elif re.search(r'(?:\bas|\))\s+\w+\s*$', item, re.IGNORECASE) is not None:
+            items.append(aggregate_pattern.sub(rewrite_aggregate, item))
+        else:
+            # 別名のない式の列名は式そのものになるため、書き換えると列名が変わってしまう
+            return sql_text, None
+
+    table_clause = f'FROM {rollup}' if alias is not None else f'FROM {rollup} AS country'
+    rest = aggregate_pattern.sub(rewrite_aggregate, sql_text[from_match.end():])
+    routed = sql_text[:select_match.end()] + ','.join(items) + table_clause + rest
+    return routed, rollup
+
+
+def rewrite_aggregate(match: re.Match) -> str:
+    """集計関数の呼び出しを、集計テーブルの列に対する呼び出しに書き換える
+
+    Parameters
+    ----------
+    match : re.Match
+        aggregate_patternのマッチ
+
+    Returns
+    -------
+    str
+    """
+
+    function = match.group('function').lower()
+    column = match.group('column').lower()
+    prefix = '' if match.group('table') is None else f'{match.group("table")}.'
+
+    # 集計の対象の列はNOT NULLのため、COUNTは対象によらず国の数となる
+    if function == 'count':
+        return f'SUM({prefix}country_count)'
+    elif function == 'avg':
+        return f'(SUM({prefix}{column}_sum) * 1.0 / SUM({prefix}country_count))'
+    else:
+        return f'{function.upper()}({prefix}{column}_{function})'
+
+
+def route_query(connection, sql_text: str) -> Tuple[str, Optional[str]]:
+    """SQL文を、検索インデックスや集計テーブルを使うクエリに書き換える
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.base.Connection
+    sql_text : str
+
+    Returns
+    -------
+    sql_text : str
+        書き換えたSQL文
+    rollup : str or None
+        集計テーブルを使うように書き換えた場合は、集計テーブルのテーブル名
+    """
+
+    # 書き換えの判定と書き換えはコメントを取り除いたSQL文に対して行い、コメント内の語を書き換えないようにする
+    uncommented = strip_sql(strip_comments(sql_text))
+
+    routed, rollup = route_rollup(connection, uncommented)
+    if rollup is not None:
+        return routed, rollup
+
+    routed = route_search_index(connection, uncommented)
+    if routed != uncommented:
+        return routed, None
+
+    return strip_sql(sql_text), None
+
+
+def has_table(connection, table_name: str) -> bool:
+    """DBにテーブルがあるかを判定する
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.base.Connection
+    table_name : str
+
+    Returns
+    -------
+    bool
+    """
+
+    row = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+    ).fetchone()
+    return row is not None
+
+
+def wrap_sql(sql_text: str, outer_template: str) -> str:
+    """SQL文をサブクエリとして外側のクエリに埋め込む
+
+    SQL文が行コメントで終わる場合でも閉じ括弧がコメントアウトされないように、
+    サブクエリの前後に改行を挟む。
+
+    Parameters
+    ----------
+    sql_text : str
+    outer_template : str
+        サブクエリを埋め込む位置に`{}`を含むSQL文
+
+    Returns
+    -------
+    str
+    """
+
+    return outer_template.format(f'(\n{strip_sql(sql_text)}\n)')
+
+
+@contextmanager
+def time_limited_connection(engine, time_budget: float, cancel_event: Optional[threading.Event] = None):
+    """実行時間の上限を設定した接続を与える
+
+    SQLiteのプログレスハンドラで経過時間を監視し、上限を超えたらクエリを中断させる。
+    中断された場合はQueryTimeoutを送出する。
+    cancel_eventがセットされた場合もクエリを中断させ、QueryCancelledを送出する。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine
+    time_budget : float
+        実行時間の上限(秒)
+    cancel_event : threading.Event, optional
+        クエリをキャンセルするためのイベント
+
+    Yields
+    ------
+    connection : sqlalchemy.engine.base.Connection
+    """
+
+    assert time_budget > 0
+
+    connection = engine.connect()
+    dbapi_connection = connection.connection.connection
+
+    start = time.perf_counter()
+    deadline = start + time_budget
+    interrupted = False
+    cancelled = False
+
+    def handler() -> int:
+        nonlocal interrupted, cancelled
+        # 0以外の値を返すと、実行中のクエリが中断される
+        interrupted = time.perf_counter() > deadline
+        cancelled = cancel_event is not None and cancel_event.is_set()
+        return int(interrupted or cancelled)
+
+    dbapi_connection.set_progress_handler(handler, progress_interval)
+    try:
+        yield connection
+    except Exception:
+        if cancelled:
+            raise QueryCancelled()
+        if interrupted:
+            raise QueryTimeout(time.perf_counter() - start)
+        raise
+    finally:
+        dbapi_connection.set_progress_handler(None, 0)
+        connection.close()
+
+
+def run_query(
+    engine, sql_text: str, max_rows: int, time_budget: float,
+    cancel_event: Optional[threading.Event] = None, on_progress: Optional[Callable[[int], None]] = None
+) -> QueryResult:
+    """クエリを実行し、先頭からmax_rows行までの結果を取得する
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine
+    sql_text : str
+    max_rows : int
+        取得する行数の上限
+    time_budget : float
+        実行時間の上限(秒)
+    cancel_event : threading.Event, optional
+        クエリをキャンセルするためのイベント
+    on_progress : Callable[[int], None], optional
+        fetch_chunk_size行を取得するたびに、それまでに取得した行数を渡して呼び出す関数
+
+    Returns
+    -------
+    QueryResult
+    """
+
+    assert max_rows > 0
+
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    with ExitStack() as stack:
+        with measure_time(timings, 'connect'):
+            connection = stack.enter_context(time_limited_connection(engine, time_budget, cancel_event))
+
+        with measure_time(timings, 'execute'):
+            sql, rollup = route_query(connection, sql_text)
+            result = connection.execute(sql)
+
+        with measure_time(timings, 'fetch'):
+            columns: List[str] = []
+            rows: List[tuple] = []
+            if result.returns_rows:
+                columns = list(result.keys())
+                # 上限を超えたかを判定するため、1行多く取得する
+                while len(rows) <= max_rows:
+                    chunk = result.fetchmany(min(fetch_chunk_size, max_rows + 1 - len(rows)))
+                    if not chunk:
+                        break
+                    # RowProxyのままではキャッシュのバイト数の見積もりに値が含まれないため、tupleに変換する
+                    rows.extend(tuple(row) for row in chunk)
+                    if on_progress is not None:
+                        on_progress(len(rows))
+            result.close()
+
+    truncated = len(rows) > max_rows
+    return QueryResult(columns, rows[:max_rows], truncated, time.perf_counter() - start, timings, rollup)
+
+
+def explain_query(engine, sql_text: str, time_budget: float) -> QueryPlan:
+    """クエリの実行計画を取得し、クエリを実行して実行時間を計測する
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine
+    sql_text : str
+    time_budget : float
+        実行時間の上限(秒)
+
+    Returns
+    -------
+    QueryPlan
+    """
+
+    with time_limited_connection(engine, time_budget) as connection:
+        sql, rollup = route_query(connection, sql_text)
+        plan_rows = connection.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+
+    # EXPLAIN QUERY PLANの各行は(id, parent, notused, detail)で、parentが親の行のidを表す
+    depths = {0: -1}
+    lines = []
+    for id_, parent, _, detail in plan_rows:
+        depths[id_] = depths.get(parent, -1) + 1
+        lines.append('  ' * depths[id_] + detail)
+
+    start = time.perf_counter()
+    num_rows = 0
+    try:
+        with time_limited_connection(engine, time_budget) as connection:
+            sql, _ = route_query(connection, sql_text)
+            result = connection.execute(sql)
+            if result.returns_rows:
+                for chunk in iter(lambda: result.fetchmany(1000), []):
+                    num_rows += len(chunk)
+            result.close()
+    except QueryTimeout as e:
+        return QueryPlan(lines, e.elapsed, num_rows, True, rollup)
+
+    return QueryPlan(lines, time.perf_counter() - start, num_rows, False, rollup)
+
+
+def fetch_page(
+    engine, sql_text: str, page_current: int, page_size: int, time_budget: float
+) -> Tuple[List[str], List[tuple], Optional[str]]:
+    """クエリ結果のうち、指定したページの行だけを取得する
+
+    SQL文をLIMIT/OFFSET付きのサブクエリで包むため、ページ外の行はSQLite側で読み飛ばされ、
+    Python側には転送されない。
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine
+    sql_text : str
+        SELECT文
+    page_current : int
+        0始まりのページ番号
+    page_size : int
+        1ページあたりの行数
+    time_budget : float
+        実行時間の上限(秒)
+
+    Returns
+    -------
+    columns : List[str]
+        列名のリスト
+    rows : List[tuple]
+        ページ内の行のリスト
+    rollup : str or None
+        集計テーブルから結果を取得した場合は、その集計テーブルのテーブル名
+    """
+
+    assert page_current >= 0
+    assert page_size > 0
+
+    with time_limited_connection(engine, time_budget) as connection:
+        sql, rollup = route_query(connection, sql_text)
+        sql = wrap_sql(sql, 'SELECT * FROM {} LIMIT ? OFFSET ?')
+        result = connection.execute(sql, (page_size, page_current * page_size))
+        columns = list(result.keys())
+        rows = [tuple(row) for row in result.fetchall()]
+        result.close()
+
+    return columns, rows, rollup
+
+
+def count_rows(engine, sql_text: str, time_budget: float) -> int:
+    """クエリ結果の行数を取得する
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.base.Engine
+    sql_text : str
+        SELECT文
+    time_budget : float
+        実行時間の上限(秒)
+
+    Returns
+    -------
+    int
+    """
+
+    with time_limited_connection(engine, time_budget) as connection:
+        sql, _ = route_query(connection, sql_text)
+        sql = wrap_sql(sql, 'SELECT COUNT(*) FROM {}')
+        count = connection.execute(sql).scalar()
+    return count
@@ -18,3 +18,11 @@ contain_j_lines = [
     'FROM country',
     'WHERE name LIKE "%j%"'
 ]
+
+search_land_lines = [
+    'SELECT c.name, c.area, c.population',
+    'FROM country c',
+    'WHERE c.rowid IN (',
+    '    SELECT rowid FROM country_name_fts WHERE name LIKE "%land%"',
+    ')'
+]
@@ -0,0 +1,22 @@
+from contextlib import contextmanager
+import time
+from typing import Dict
+
+
+@contextmanager
+def measure_time(timings: Dict[str, float], stage: str):
+    """処理の実行時間を計測し、timingsに記録する
+
+    Parameters
+    ----------
+    timings : dict[str, float]
+        処理名をkey、実行時間(秒)をvalueとするdict
+    stage : str
+        処理名
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
@@ -1,18 +1,32 @@
-from typing import List, NamedTuple
+import functools
+from typing import List, NamedTuple, Optional
 
 import dash
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 from dash_table import DataTable
+import flask
 import numpy as np
 
 import slider
-from figure import draw_swarm_plot
-from ttest import perform_ttest
+from figure import draw_power_curve, make_swarm_plot_data, make_swarm_plot_templates
+import resampling
+import simulation
+import streaming
+from ttest import SampleStats, compute_sample_stats, perform_ttest
 
 
+# シード値を指定した場合の結果を保持するキャッシュの最大件数
+result_cache_size = 256
+
+# 検出力シミュレーションで棄却率を求める平均の差
+simulation_differences = np.round(np.arange(-2, 2.01, 0.25), 2)
+# 検出力シミュレーションで生成するデータ数の上限
+max_simulation_elements = 500000000
+
 app = dash.Dash(
     name=__name__,
     external_stylesheets=[dbc.themes.BOOTSTRAP],
@@ -68,6 +82,19 @@ app.layout = dbc.Container(
                                 value='two-sided',
                                 clearable=False
                             ),
+                            html.H6(children='検定方法'),
+                            dcc.Dropdown(
+                                id='test-method',
+                                className='ml-3 mb-1',
+                                style={'width': '240px', 'font-size': '12px'},
+                                options=[
+                                    {'label': 't検定', 'value': 't-test'},
+                                    {'label': '並べ替え検定', 'value': 'permutation'},
+                                    {'label': 'ブートストラップ信頼区間', 'value': 'bootstrap'}
+                                ],
+                                value='t-test',
+                                clearable=False
+                            ),
                             html.H6(children='有意水準'),
                             dcc.RadioItems(
                                 id='significance-level',
@@ -79,7 +106,28 @@ app.layout = dbc.Container(
                                     {'label': 0.01, 'value': 0.01}
                                 ],
                                 value=0.05,
-                            )
+                            ),
+                            html.H6(children='等分散の仮定'),
+                            dcc.RadioItems(
+                                id='equal-variance',
+                                className='ml-3 mb-1',
+                                labelClassName='ml-3',
+                                labelStyle={'display': 'inline-block'},
+                                options=[
+                                    {'label': 'あり (スチューデント)', 'value': 'yes'},
+                                    {'label': 'なし (ウェルチ)', 'value': 'no'}
+                                ],
+                                value='yes'
+                            ),
+                            html.H6(children='ストリーミング'),
+                            dcc.Checklist(
+                                id='checklist-streaming',
+                                className='ml-3 mb-1',
+                                options=[{'label': '1秒ごとにデータを追加する', 'value': 'yes'}],
+                                value=[]
+                            ),
+                            dcc.Interval(id='stream-interval', interval=1000, disabled=True),
+                            dcc.Store(id='stream-state')
                         ]
                     )
                 ),
@@ -131,7 +179,12 @@ app.layout = dbc.Container(
             children=[
                 dbc.Col(
                     className='col-6',
-                    children=dcc.Graph(id='generated-data')
+                    children=[
+                        dcc.Graph(id='generated-data'),
+                        # Swarm Plotのレイアウトはページの読み込み時に送り、更新時はtraceのデータだけを送る
+                        dcc.Store(id='swarm-plot-templates', data=make_swarm_plot_templates()),
+                        dcc.Store(id='swarm-plot-data')
+                    ]
                 ),
                 dbc.Col(
                     className='col-6',
@@ -158,20 +211,63 @@ app.layout = dbc.Container(
                     ]
                 )
             ]
+        ),
+        dbc.Row(
+            className='border-top pt-3 mt-3',
+            children=[
+                dbc.Col(
+                    className='col-4',
+                    children=[
+                        html.H5('検出力シミュレーション'),
+                        html.Div(
+                            className='border p-2 mb-2',
+                            children=[
+                                html.H6(children='反復回数'),
+                                dcc.Dropdown(
+                                    id='num-replicates',
+                                    className='ml-3 mb-2',
+                                    style={'width': '160px', 'font-size': '12px'},
+                                    options=[
+                                        {'label': f'{n:,}回', 'value': n}
+                                        for n in (1000, 10000, 100000)
+                                    ],
+                                    value=10000,
+                                    clearable=False
+                                ),
+                                dbc.Button(
+                                    id='simulation-button',
+                                    color='info',
+                                    size='sm',
+                                    children='シミュレーションを実行'
+                                )
+                            ]
+                        ),
+                        html.Div(
+                            id='simulation-result',
+                            className='p-2 ml-2',
+                            style={'white-space': 'pre', 'font-family': 'monospace', 'font-size': '14px'}
+                        )
+                    ]
+                ),
+                dbc.Col(
+                    className='col-8',
+                    children=dcc.Loading(dcc.Graph(id='power-curve'))
+                )
+            ]
         )
     ]
 )
 
 
-def make_stats_table_data(data_a: np.array, data_b: np.array):
+def make_stats_table_data(stats_a: SampleStats, stats_b: SampleStats):
     """データの統計情報テーブルのデータを出力する
 
     Parameters
     ----------
-    data_a : np.array
-        1次元の配列
-    data_b : np.array
-        1次元の配列
+    stats_a : ttest.SampleStats
+        データ群Aの十分統計量
+    stats_b : ttest.SampleStats
+        データ群Bの十分統計量
 
     Returns
     -------
@@ -180,19 +276,16 @@ def make_stats_table_data(data_a: np.array, data_b: np.array):
         各dictのkeyはDataTableのcolumnsに設定されたid、valueはセルの値に対応する。
     """
 
-    assert data_a.ndim == 1
-    assert data_b.ndim == 1
-
     class Row(NamedTuple):
         stats: str
         data_a: float
         data_b: float
 
     rows = [
-        Row('データ数', len(data_a), len(data_b)),
-        Row('標本平均', data_a.mean(), data_b.mean()),
-        Row('標本分散', data_a.var(ddof=0), data_b.var(ddof=0)),
-        Row('不偏分散', data_a.var(ddof=1), data_b.var(ddof=1))
+        Row('データ数', stats_a.num_data, stats_b.num_data),
+        Row('標本平均', stats_a.mean, stats_b.mean),
+        Row('標本分散', stats_a.variance(ddof=0), stats_b.variance(ddof=0)),
+        Row('不偏分散', stats_a.variance(ddof=1), stats_b.variance(ddof=1))
     ]
 
     stats_table_data = [
@@ -202,16 +295,26 @@ def make_stats_table_data(data_a: np.array, data_b: np.array):
     return stats_table_data
 
 
-@app.callback(
+# 表示の切り替えやスライダーの値の表示だけを行うコールバックは、サーバーとの通信をなくすためにブラウザで実行する
+app.clientside_callback(
+    """
+    function(checklistGiveSeed) {
+        return !(checklistGiveSeed && checklistGiveSeed.length);
+    }
+    """,
     output=Output('seed', 'disabled'),
     inputs=Input('checklist-give-seed', 'value')
 )
-def enable_seed(checklist_give_seed: List[str]):
-    enable = bool(checklist_give_seed)
-    return not enable
 
 
-@app.callback(
+app.clientside_callback(
+    """
+    function(numDataA, numDataB) {
+        // スライダーの値はデータ数の常用対数のため、NumDataParameterSlider.to_num_dataと同じく変換する
+        const toNumData = value => Math.round(Math.pow(10, value)).toLocaleString();
+        return ['データ数 : ' + toNumData(numDataA), 'データ数 : ' + toNumData(numDataB)];
+    }
+    """,
     output=[
         Output('num-data-a', 'children'),
         Output('num-data-b', 'children')
@@ -221,13 +324,14 @@ def enable_seed(checklist_give_seed: List[str]):
         Input('slider-num-data-b', 'value')
     ]
 )
-def select_num_data(num_data_a: str, num_data_b: str):
-    text_a = f'データ数 : {num_data_a}'
-    text_b = f'データ数 : {num_data_b}'
-    return text_a, text_b
 
 
-@app.callback(
+app.clientside_callback(
+    """
+    function(locA, locB) {
+        return ['平均 : ' + locA, '平均 : ' + locB];
+    }
+    """,
     output=[
         Output('loc-data-a', 'children'),
         Output('loc-data-b', 'children')
@@ -237,64 +341,333 @@ def select_num_data(num_data_a: str, num_data_b: str):
         Input('slider-loc-data-b', 'value')
     ]
 )
-def select_loc(loc_a: str, loc_b: str):
-    text_a = f'平均 : {loc_a}'
-    text_b = f'平均 : {loc_b}'
-    return text_a, text_b
 
 
-@app.callback(
+# 等分散を仮定する場合は、データ群Bの分散をデータ群Aの分散に合わせ、変更できないようにする
+app.clientside_callback(
+    """
+    function(variance, equalVariance) {
+        const equal = equalVariance === 'yes';
+        return ['分散 : ' + variance, equal ? variance : window.dash_clientside.no_update, equal];
+    }
+    """,
     output=[
         Output('variance-data-a', 'children'),
-        Output('variance-data-b', 'children'),
-        Output('slider-variance-data-b', 'value')
+        Output('slider-variance-data-b', 'value'),
+        Output('slider-variance-data-b', 'disabled')
     ],
-    inputs=Input('slider-variance-data-a', 'value')
+    inputs=[
+        Input('slider-variance-data-a', 'value'),
+        Input('equal-variance', 'value')
+    ]
+)
+
+
+app.clientside_callback(
+    """
+    function(variance) {
+        return '分散 : ' + variance;
+    }
+    """,
+    output=Output('variance-data-b', 'children'),
+    inputs=Input('slider-variance-data-b', 'value')
+)
+
+
+app.clientside_callback(
+    """
+    function(checklistStreaming) {
+        return !(checklistStreaming && checklistStreaming.length);
+    }
+    """,
+    output=Output('stream-interval', 'disabled'),
+    inputs=Input('checklist-streaming', 'value')
+)
+
+
+# traceのデータを、表示方法に応じたfigureのテンプレートに当てはめてSwarm Plotを描写する
+app.clientside_callback(
+    """
+    function(plotData, templates) {
+        if (!plotData) {
+            return window.dash_clientside.no_update;
+        }
+        const figure = JSON.parse(JSON.stringify(templates[plotData.mode]));
+        plotData.data.forEach((trace, i) => Object.assign(figure.data[i], trace));
+        return figure;
+    }
+    """,
+    output=Output('generated-data', 'figure'),
+    inputs=Input('swarm-plot-data', 'data'),
+    state=State('swarm-plot-templates', 'data')
 )
-def select_variance(variance: str):
-    text_a = f'分散 : {variance}'
-    text_b = f'分散 : {variance}'
-    return text_a, text_b, variance
 
 
 @app.callback(
     output=[
-        Output('generated-data', 'figure'),
+        Output('swarm-plot-data', 'data'),
         Output('stats-table', 'data'),
-        Output('t-test-result', 'children')
+        Output('t-test-result', 'children'),
+        Output('stream-state', 'data')
     ],
     inputs=[
+        Input('stream-interval', 'n_intervals'),
         Input('checklist-give-seed', 'value'),
         Input('seed', 'value'),
         Input('alternative-hypothesis', 'value'),
+        Input('test-method', 'value'),
         Input('significance-level', 'value'),
+        Input('equal-variance', 'value'),
         Input('slider-num-data-a', 'value'),
         Input('slider-num-data-b', 'value'),
         Input('slider-loc-data-a', 'value'),
         Input('slider-loc-data-b', 'value'),
         Input('slider-variance-data-a', 'value'),
         Input('slider-variance-data-b', 'value')
-    ]
+    ],
+    state=State('stream-state', 'data')
 )
 def generate_data(
-    checklist_give_seed: List[str], seed: int, alternative: str,
-    significance_level: float, num_data_a: int, num_data_b: int,
-    loc_a: float, loc_b: float, variance_a: float, variance_b: float,
+    n_intervals: int, checklist_give_seed: List[str], seed: int, alternative: str, test_method: str,
+    significance_level: float, equal_variance: str, num_data_a: float, num_data_b: float,
+    loc_a: float, loc_b: float, variance_a: float, variance_b: float, stream_state: Optional[dict]
 ):
     assert variance_a > 0
     assert variance_b > 0
 
-    if checklist_give_seed:
-        np.random.seed(seed)
+    num_data_a = slider.NumDataParameterSlider.to_num_data(num_data_a)
+    num_data_b = slider.NumDataParameterSlider.to_num_data(num_data_b)
+
+    # ストリーミングでは、データ数のスライダーの値を1回に追加するデータ数とする
+    triggered = dash.callback_context.triggered
+    if triggered and triggered[0]['prop_id'] == 'stream-interval.n_intervals':
+        return stream_data(
+            stream_state, seed if checklist_give_seed else None, alternative, significance_level,
+            equal_variance == 'yes', num_data_a, num_data_b, loc_a, loc_b, variance_a, variance_b
+        )
+
+    params = (
+        alternative, test_method, significance_level, equal_variance == 'yes',
+        num_data_a, num_data_b, loc_a, loc_b, variance_a, variance_b
+    )
+
+    # 設定を変更した場合は、ストリーミングで追加したデータを破棄する
+    # シード値を指定した場合、結果は入力だけで決まるため、同じ入力の結果はキャッシュから返す
+    if checklist_give_seed and seed is not None:
+        return (*build_seeded_result(seed, *params), None)
+
+    return (*build_result(None, *params), None)
+
+
+def stream_data(
+    stream_state: Optional[dict], seed: Optional[int], alternative: str, significance_level: float, equal_var: bool,
+    num_data_a: int, num_data_b: int, loc_a: float, loc_b: float, variance_a: float, variance_b: float
+) -> tuple:
+    """ストリーミングの状態にデータを追加し、Swarm Plotのデータ、統計情報テーブルのデータ、t検定の結果を出力する
+
+    統計情報とt検定は、これまでのデータの十分統計量を追加したデータの十分統計量で更新して計算する。
+    Swarm Plotには、これまでのデータから一様に抽出したサンプルを描写する。
+    データ群の全てのデータが必要な並べ替え検定とブートストラップ法は行わず、t検定を行う。
+
+    Parameters
+    ----------
+    stream_state : dict or None
+        streaming.StreamState.to_dictで変換したストリーミングの状態。Noneの場合は、新しくストリーミングを開始する
+    seed : int or None
+        シード値。指定した場合は、バッチごとにシード値とバッチの番号から乱数生成器を生成する
+    alternative : str
+        対立仮説。two-sided, less, greaterのいずれか。
+    significance_level : float
+        有意水準
+    equal_var : bool
+        Trueの場合はスチューデントのt検定、Falseの場合はウェルチのt検定を行う
+    num_data_a, num_data_b : int
+        各データ群に追加するデータ数
+    loc_a, loc_b : float
+        各データ群の平均
+    variance_a, variance_b : float
+        各データ群の分散
+
+    Returns
+    -------
+    plot_data : dict
+        Swarm Plotのtraceのデータ。figure.make_swarm_plot_dataを参照する
+    stats_table_data : list[dict[str, float]]
+    ttest_result : str
+    stream_state : dict
+        更新したストリーミングの状態
+    """
+
+    state = None if stream_state is None else streaming.StreamState.from_dict(stream_state)
+    num_batches = 0 if state is None else state.num_batches
+
+    rng = np.random.default_rng(None if seed is None else [seed, num_batches])
+    batch_a = rng.normal(loc_a, np.sqrt(variance_a), num_data_a)
+    batch_b = rng.normal(loc_b, np.sqrt(variance_b), num_data_b)
+    state = streaming.append_batch(state, batch_a, batch_b, rng)
+
+    plot_data = make_swarm_plot_data(np.array(state.reservoir_a), np.array(state.reservoir_b))
+    stats_table_data = make_stats_table_data(state.stats_a, state.stats_b)
+    ttest_result = perform_ttest(state.stats_a, state.stats_b, alternative, significance_level, equal_var)
+
+    return plot_data, stats_table_data, ttest_result, state.to_dict()
+
+
+@functools.lru_cache(maxsize=result_cache_size)
+def build_seeded_result(
+    seed: int, alternative: str, test_method: str, significance_level: float, equal_var: bool,
+    num_data_a: int, num_data_b: int, loc_a: float, loc_b: float, variance_a: float, variance_b: float
+) -> tuple:
+    """シード値を指定した場合の結果を生成し、キャッシュする
+
+    引数と返り値はbuild_resultと同じ。
+    """
+
+    return build_result(
+        seed, alternative, test_method, significance_level, equal_var,
+        num_data_a, num_data_b, loc_a, loc_b, variance_a, variance_b
+    )
 
-    data_a = np.random.normal(loc_a, np.sqrt(variance_a), num_data_a)
-    data_b = np.random.normal(loc_b, np.sqrt(variance_b), num_data_b)
 
-    fig = draw_swarm_plot(data_a, data_b)
-    stats_table_data = make_stats_table_data(data_a, data_b)
-    ttest_result = perform_ttest(data_a, data_b, alternative, significance_level)
+def build_result(
+    seed: Optional[int], alternative: str, test_method: str, significance_level: float, equal_var: bool,
+    num_data_a: int, num_data_b: int, loc_a: float, loc_b: float, variance_a: float, variance_b: float
+) -> tuple:
+    """データを生成し、Swarm Plotのデータ、統計情報テーブルのデータ、t検定の結果を出力する
+
+    Parameters
+    ----------
+    seed : int or None
+        シード値。Noneの場合は、毎回異なるデータを生成する
+    alternative : str
+        対立仮説。two-sided, less, greaterのいずれか。
+    test_method : str
+        検定方法。t-test, permutation, bootstrapのいずれか。
+    significance_level : float
+        有意水準
+    equal_var : bool
+        t検定の場合、Trueの場合はスチューデントのt検定、Falseの場合はウェルチのt検定を行う
+    num_data_a, num_data_b : int
+        各データ群のデータ数
+    loc_a, loc_b : float
+        各データ群の平均
+    variance_a, variance_b : float
+        各データ群の分散
+
+    Returns
+    -------
+    plot_data : dict
+        Swarm Plotのtraceのデータ。figure.make_swarm_plot_dataを参照する
+    stats_table_data : list[dict[str, float]]
+    ttest_result : str
+    """
+
+    # グローバルな乱数の状態を変更すると、同時に処理しているリクエストの結果が再現できなくなるため、
+    # リクエストごとに乱数生成器を生成する
+    # データ群ごとに独立した系列を使い、一方のデータ数を変えても他方のデータが変わらないようにする
+    # リサンプリングにも独立した系列を使う
+    seed_sequence = np.random.SeedSequence(seed)
+    seed_a, seed_b, seed_resampling = seed_sequence.spawn(3)
+    rng_a, rng_b = np.random.default_rng(seed_a), np.random.default_rng(seed_b)
+
+    data_a = rng_a.normal(loc_a, np.sqrt(variance_a), num_data_a)
+    data_b = rng_b.normal(loc_b, np.sqrt(variance_b), num_data_b)
+
+    plot_data = make_swarm_plot_data(data_a, data_b)
+
+    # 統計情報テーブルとt検定は、データを1度だけ集計した十分統計量から計算する
+    stats_a = compute_sample_stats(data_a)
+    stats_b = compute_sample_stats(data_b)
+    stats_table_data = make_stats_table_data(stats_a, stats_b)
+    if test_method == 'permutation':
+        ttest_result = resampling.perform_permutation_test(
+            data_a, data_b, alternative, significance_level, seed=seed_resampling
+        )
+    elif test_method == 'bootstrap':
+        ttest_result = resampling.perform_bootstrap(data_a, data_b, alternative, significance_level, seed=seed_resampling)
+    else:
+        ttest_result = perform_ttest(stats_a, stats_b, alternative, significance_level, equal_var)
+
+    return plot_data, stats_table_data, ttest_result
+
+
+@app.callback(
+    output=[
+        Output('power-curve', 'figure'),
+        Output('simulation-result', 'children')
+    ],
+    inputs=Input('simulation-button', 'n_clicks'),
+    state=[
+        State('checklist-give-seed', 'value'),
+        State('seed', 'value'),
+        State('alternative-hypothesis', 'value'),
+        State('significance-level', 'value'),
+        State('equal-variance', 'value'),
+        State('num-replicates', 'value'),
+        State('slider-num-data-a', 'value'),
+        State('slider-num-data-b', 'value'),
+        State('slider-loc-data-a', 'value'),
+        State('slider-loc-data-b', 'value'),
+        State('slider-variance-data-a', 'value'),
+        State('slider-variance-data-b', 'value')
+    ]
+)
+def simulate_power(
+    n_clicks: int, checklist_give_seed: List[str], seed: int, alternative: str,
+    significance_level: float, equal_variance: str, num_replicates: int, num_data_a: float, num_data_b: float,
+    loc_a: float, loc_b: float, variance_a: float, variance_b: float
+):
+    if not n_clicks:
+        raise PreventUpdate
+
+    num_data_a = slider.NumDataParameterSlider.to_num_data(num_data_a)
+    num_data_b = slider.NumDataParameterSlider.to_num_data(num_data_b)
+
+    # 平均の差ごとに生成するデータ数の合計が上限を超える場合は、実行しない
+    num_elements = (num_data_a + num_data_b) * num_replicates * (len(simulation_differences) + 2)
+    if num_elements > max_simulation_elements:
+        message = f'データ数と反復回数の積が大きすぎます。データ数か反復回数を減らしてください (生成するデータ数 : {num_elements:,})'
+        return dash.no_update, message
+
+    # 現在の設定での平均の差と、差が0の場合(第一種の過誤)も求める
+    current_difference = round(loc_a - loc_b, 2)
+    differences = np.union1d(simulation_differences, [0, current_difference])
+
+    equal_var = equal_variance == 'yes'
+    empirical = simulation.simulate_rejection_rates(
+        differences, num_data_a, num_data_b, variance_a, variance_b, alternative, significance_level,
+        num_replicates, equal_var=equal_var, seed=seed if checklist_give_seed else None
+    )
+    theoretical = simulation.theoretical_rejection_rates(
+        differences, num_data_a, num_data_b, variance_a, variance_b, alternative, significance_level, equal_var
+    )
+
+    fig = draw_power_curve(differences, empirical, theoretical, current_difference)
+
+    zero_index = np.searchsorted(differences, 0)
+    current_index = np.searchsorted(differences, current_difference)
+    lines = [
+        f'反復回数           - {num_replicates:,}',
+        f'第一種の過誤の確率 - {empirical[zero_index]:.4f} (理論値 {theoretical[zero_index]:.4f})',
+        f'平均の差           - {current_difference}',
+        f'検出力             - {empirical[current_index]:.4f} (理論値 {theoretical[current_index]:.4f})'
+    ]
+    return fig, '\n'.join(lines)
+
 
-    return fig, stats_table_data, ttest_result
+@app.server.route('/metrics/cache')
+def cache_metrics():
+    info = build_seeded_result.cache_info()
+    lookups = info.hits + info.misses
+    return flask.jsonify({
+        'entries': info.currsize,
+        'max_entries': info.maxsize,
+        'hits': info.hits,
+        'misses': info.misses,
+        # キャッシュを消去しないため、キャッシュに入らなかった結果の数が追い出された件数となる
+        'evictions': info.misses - info.currsize,
+        'hit_rate': info.hits / lookups if lookups else None
+    })
 
 
 if __name__ == '__main__':
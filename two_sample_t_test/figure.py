@@ -1,35 +1,83 @@
-from typing import List
+from typing import Dict, List
 
+import numpy as np
 import plotly.graph_objects as go
 
 
-def draw_swarm_plot(data_a: List[float], data_b: List[float]) -> go.Figure:
-    """２つのデータ群のSwarm Plotを出力する
+# データ数がこの値を超えるデータ群は、全ての点を描写せず、サーバー側で集計した密度を描写する
+max_swarm_points = 2000
+
+# 密度を集計するときのビンの数
+density_bins = 100
+
+
+def make_swarm_plot_templates() -> Dict[str, dict]:
+    """Swarm Plotの、データを含まないfigureを表示方法ごとに出力する
+
+    レイアウトやテンプレートはページの読み込み時に1度だけブラウザに送り、
+    データを更新するときは、make_swarm_plot_dataで出力したtraceのデータだけを送る。
+
+    Returns
+    -------
+    dict[str, dict]
+        keyは表示方法で、swarmは全ての点の描写、densityは密度の描写を表す。
+        valueはdcc.Graphのfigureに設定するdict
+    """
+
+    swarm = go.Figure()
+    swarm.add_trace(
+        swarm_plot_box([], 'データ群A')
+    )
+    swarm.add_trace(
+        swarm_plot_box([], 'データ群B')
+    )
+    swarm.update_layout(title_text='生成データ Swarm Plot')
+
+    density = go.Figure()
+    density.add_trace(
+        binned_violin('データ群A')
+    )
+    density.add_trace(
+        binned_violin('データ群B')
+    )
+    density.update_xaxes(tickvals=[0, 1], ticktext=['データ群A', 'データ群B'])
+    density.update_layout(title_text='生成データ 密度')
+
+    templates = {}
+    for mode, fig in (('swarm', swarm), ('density', density)):
+        fig.update_layout(
+            title_x=0.5,
+            showlegend=False,
+            template='plotly_white'
+        )
+        templates[mode] = fig.to_dict()
+
+    return templates
+
+
+def make_swarm_plot_data(data_a: np.ndarray, data_b: np.ndarray) -> dict:
+    """２つのデータ群のSwarm Plotの、traceのデータだけを出力する
+
+    データ数がmax_swarm_pointsを超える場合は、全ての点を描写する代わりに、
+    ヒストグラムから求めた密度をバイオリン図として描写する。
+    この場合、ブラウザに送るデータ量はデータ数によらず一定となる。
 
     Parameters
     ----------
-    data_a : list_like[float]
-    data_b : list_like[float]
+    data_a : np.ndarray
+    data_b : np.ndarray
 
     Returns
     -------
-    plotly.graph_objects.Figure
+    dict
+        modeは表示方法で、make_swarm_plot_templatesのkeyのいずれか。
+        dataは各traceに設定する属性のdictのlist
     """
 
-    fig = go.Figure()
-    fig.add_trace(
-        swarm_plot_box(data_a, 'データ群A')
-    ),
-    fig.add_trace(
-        swarm_plot_box(data_b, 'データ群B')
-    ),
-    fig.update_layout(
-        title_text='生成データ Swarm Plot',
-        title_x=0.5,
-        showlegend=False,
-        template='plotly_white'
-    )
-    return fig
+    if max(len(data_a), len(data_b)) <= max_swarm_points:
+        return {'mode': 'swarm', 'data': [{'y': data_a}, {'y': data_b}]}
+
+    return {'mode': 'density', 'data': [binned_violin_outline(data_a, 0), binned_violin_outline(data_b, 1)]}
 
 
 def swarm_plot_box(data: List[float], name: str) -> go.Box:
@@ -58,3 +106,96 @@ def swarm_plot_box(data: List[float], name: str) -> go.Box:
         hoveron='points'
     )
     return box
+
+
+def binned_violin(name: str) -> go.Scatter:
+    """密度を描写するバイオリン図のtraceを出力する
+
+    go.Violinはブラウザで全ての点から密度を推定するため、サーバー側で集計した密度を塗りつぶした線で描写する。
+    輪郭の座標は、binned_violin_outlineで求める。
+
+    Parameters
+    ----------
+    name : str
+        データ群の名前
+
+    Returns
+    -------
+    plotly.graph_objects.Scatter
+    """
+
+    violin = go.Scatter(
+        name=name,
+        mode='lines',
+        fill='toself',
+        hoveron='fills',
+        hoverinfo='name'
+    )
+    return violin
+
+
+def binned_violin_outline(data: np.ndarray, position: int) -> Dict[str, np.ndarray]:
+    """データ群をビンに集計し、密度を表すバイオリン図の輪郭の座標を出力する
+
+    Parameters
+    ----------
+    data : np.ndarray
+    position : int
+        バイオリン図の中心のx座標
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        輪郭のx座標とy座標
+    """
+
+    counts, edges = np.histogram(data, bins=density_bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    # バイオリン図の幅は、最も密度が高いビンで0.8とする
+    widths = counts / counts.max() * 0.4
+
+    # 右側の輪郭を下から上へ、左側の輪郭を上から下へたどる
+    return {
+        'x': position + np.concatenate([widths, -widths[::-1]]),
+        'y': np.concatenate([centers, centers[::-1]])
+    }
+
+
+def draw_power_curve(
+    differences: np.ndarray, empirical: np.ndarray, theoretical: np.ndarray, current_difference: float
+) -> go.Figure:
+    """平均の差ごとの棄却率を、シミュレーションの結果と理論値で比較するグラフを出力する
+
+    Parameters
+    ----------
+    differences : np.ndarray
+        データ群Aの平均からデータ群Bの平均を引いた差
+    empirical : np.ndarray
+        シミュレーションで求めた棄却率
+    theoretical : np.ndarray
+        理論的な棄却率
+    current_difference : float
+        現在の設定での平均の差。縦線で表示する
+
+    Returns
+    -------
+    plotly.graph_objects.Figure
+    """
+
+    fig = go.Figure()
+    fig.add_trace(
+        go.Scatter(x=differences, y=theoretical, name='理論値', mode='lines')
+    )
+    fig.add_trace(
+        go.Scatter(x=differences, y=empirical, name='シミュレーション', mode='markers')
+    )
+    fig.add_vline(x=current_difference, line_dash='dot', line_color='gray')
+    fig.update_layout(
+        title_text='平均の差ごとの棄却率',
+        title_x=0.5,
+        xaxis_title='平均の差 (A - B)',
+        yaxis_title='棄却率',
+        yaxis_range=[0, 1.05],
+        template='plotly_white'
+    )
+    return fig
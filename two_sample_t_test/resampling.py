@@ -0,0 +1,407 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from ttest import write_formal_alternative
+
+
+# 1回のリサンプリングで生成するインデックス行列の要素数の上限
+max_batch_elements = 1000000
+
+# リサンプリングするデータの要素数の合計の上限。データ数が多い場合は、リサンプリングの回数を減らす
+max_resampling_elements = 200000000
+
+# 残りのリサンプリングするデータの要素数の合計がこの値以上の場合、プロセスプールで並列に実行する
+parallel_threshold = 50000000
+
+# 並べ替え検定を途中で打ち切るかを判定するまでに、最低限リサンプリングする回数
+min_permutations = 1000
+
+# プロセスプールの各プロセスが保持するデータ。プロセスプールの各プロセスで_init_workerが設定する
+_worker_data: Tuple[np.ndarray, ...] = ()
+
+
+class PermutationResult(NamedTuple):
+    """並べ替え検定の結果
+
+    Attributes
+    ----------
+    statistic : float
+        平均の差の観測値
+    p_value : float
+        p値
+    num_permutations : int
+        実際にリサンプリングした回数
+    standard_error : float
+        p値のモンテカルロ誤差の推定値
+    """
+
+    statistic: float
+    p_value: float
+    num_permutations: int
+    standard_error: float
+
+
+class BootstrapResult(NamedTuple):
+    """ブートストラップ法による信頼区間
+
+    Attributes
+    ----------
+    statistic : float
+        平均の差の観測値
+    low : float
+        信頼区間の下限
+    high : float
+        信頼区間の上限
+    num_resamples : int
+        リサンプリングした回数
+    """
+
+    statistic: float
+    low: float
+    high: float
+    num_resamples: int
+
+
+def permutation_test(
+    data_a: np.ndarray, data_b: np.ndarray, alternative: str, max_permutations: int,
+    precision: float = 0.001, seed: Optional[np.random.SeedSequence] = None, max_workers: Optional[int] = None
+) -> PermutationResult:
+    """平均の差を統計量とする並べ替え検定を行う
+
+    2つのデータ群を合わせたデータから、データ群Aに割り当てるインデックスの行列をまとめて生成し、
+    各行の平均の差をベクトル演算で求める。
+    p値のモンテカルロ誤差がprecisionを下回った時点で、リサンプリングを打ち切る。
+    多くの場合はmin_permutations回で打ち切られるため、まずは呼び出したスレッドで実行し、
+    打ち切れなかった場合に残りの回数からプロセスプールで並列に実行するかを決める。
+
+    Parameters
+    ----------
+    data_a : np.ndarray
+    data_b : np.ndarray
+    alternative : str
+        対立仮説。two-sided, less, greaterのいずれか。
+    max_permutations : int
+        リサンプリングする回数の上限
+    precision : float, optional
+        p値に求める精度。デフォルト値は0.001
+    seed : np.random.SeedSequence, optional
+        乱数のシード。Noneの場合は、毎回異なる結果となる
+    max_workers : int, optional
+        並列に実行する場合のプロセス数。Noneの場合はCPUのコア数
+
+    Returns
+    -------
+    PermutationResult
+    """
+
+    pooled = np.concatenate([data_a, data_b])
+    observed = data_a.mean() - data_b.mean()
+    batch_size = max(1, max_batch_elements // len(pooled))
+    seed_sequence = seed if seed is not None else np.random.SeedSequence()
+
+    count = 0
+    num_permutations = 0
+    with _ResamplingPool(max_workers, pooled, len(data_a)) as pool:
+        while num_permutations < max_permutations:
+            if num_permutations >= min_permutations:
+                pool.start(len(pooled) * (max_permutations - num_permutations))
+
+            # 並列に実行する場合は、プロセス数だけのバッチを1組として実行し、組ごとに打ち切るかを判定する
+            sizes: List[int] = []
+            for _ in range(pool.num_workers):
+                size = min(batch_size, max_permutations - num_permutations - sum(sizes))
+                if size > 0:
+                    sizes.append(size)
+            tasks = [
+                (size, child, observed, alternative)
+                for size, child in zip(sizes, seed_sequence.spawn(len(sizes)))
+            ]
+
+            count += sum(pool.map(_count_extreme_permutations, tasks))
+            num_permutations += sum(sizes)
+
+            p_value, standard_error = _permutation_p_value(count, num_permutations)
+            if num_permutations >= min_permutations and standard_error < precision:
+                break
+
+    return PermutationResult(float(observed), p_value, num_permutations, standard_error)
+
+
+def bootstrap_confidence_interval(
+    data_a: np.ndarray, data_b: np.ndarray, alternative: str, significance_level: float, num_resamples: int,
+    seed: Optional[np.random.SeedSequence] = None, max_workers: Optional[int] = None
+) -> BootstrapResult:
+    """平均の差の信頼区間を、パーセンタイル・ブートストラップ法で求める
+
+    各データ群から復元抽出するインデックスの行列をまとめて生成し、各行の平均の差をベクトル演算で求める。
+    信頼区間は、対立仮説がtwo-sidedの場合は両側、lessの場合は上限だけ、greaterの場合は下限だけとする。
+
+    Parameters
+    ----------
+    data_a : np.ndarray
+    data_b : np.ndarray
+    alternative : str
+        対立仮説。two-sided, less, greaterのいずれか。
+    significance_level : float
+        有意水準。信頼係数は1 - significance_levelとなる
+    num_resamples : int
+        リサンプリングする回数
+    seed : np.random.SeedSequence, optional
+        乱数のシード。Noneの場合は、毎回異なる結果となる
+    max_workers : int, optional
+        並列に実行する場合のプロセス数。Noneの場合はCPUのコア数
+
+    Returns
+    -------
+    BootstrapResult
+        片側の信頼区間の場合、もう一方の端は無限大となる
+    """
+
+    num_data = len(data_a) + len(data_b)
+    batch_size = max(1, max_batch_elements // num_data)
+    sizes = [min(batch_size, num_resamples - start) for start in range(0, num_resamples, batch_size)]
+    seed_sequence = seed if seed is not None else np.random.SeedSequence()
+    tasks = [(size, child) for size, child in zip(sizes, seed_sequence.spawn(len(sizes)))]
+
+    with _ResamplingPool(max_workers, data_a, data_b) as pool:
+        pool.start(num_data * num_resamples)
+        differences = np.concatenate(pool.map(_bootstrap_differences, tasks))
+
+    low, high = -np.inf, np.inf
+    if alternative == 'two-sided':
+        low, high = np.percentile(differences, [100 * significance_level / 2, 100 * (1 - significance_level / 2)])
+    elif alternative == 'less':
+        high = np.percentile(differences, 100 * (1 - significance_level))
+    else:
+        low = np.percentile(differences, 100 * significance_level)
+
+    return BootstrapResult(float(data_a.mean() - data_b.mean()), float(low), float(high), num_resamples)
+
+
+def perform_permutation_test(
+    data_a: np.ndarray, data_b: np.ndarray, alternative: str, significance_level: float,
+    max_permutations: int = 100000, seed: Optional[np.random.SeedSequence] = None
+) -> str:
+    """並べ替え検定を実行し、結果のサマリを出力する
+
+    Parameters
+    ----------
+    data_a : np.ndarray
+    data_b : np.ndarray
+    alternative : str
+        対立仮説。two-sided, less, greaterのいずれか。
+    significance_level : float
+        有意水準
+    max_permutations : int, optional
+        リサンプリングする回数の上限。デフォルト値は100000
+    seed : np.random.SeedSequence, optional
+        乱数のシード
+
+    Returns
+    -------
+    str
+    """
+
+    max_permutations = _limit_resamples(max_permutations, len(data_a) + len(data_b))
+    result = permutation_test(data_a, data_b, alternative, max_permutations, seed=seed)
+
+    if result.p_value < significance_level:
+        test_result = '帰無仮説は棄却される'
+    else:
+        test_result = '帰無仮説は棄却されない'
+
+    lines = [
+        'データ群の関係 - 独立',
+        '帰無仮説       - データ群Aの平均 ＝ データ群Bの平均',
+        '対立仮説       - {}'.format(write_formal_alternative(alternative)),
+        '有意水準       - {}'.format(significance_level),
+        '検定方法       - 並べ替え検定',
+        '平均の差       - {}'.format(result.statistic),
+        'p値            - {} (誤差 {:.4f})'.format(result.p_value, result.standard_error),
+        '並べ替え回数   - {:,}'.format(result.num_permutations),
+        '検定結果       - {}'.format(test_result)
+    ]
+
+    summary = '\n'.join(lines)
+    return summary
+
+
+def perform_bootstrap(
+    data_a: np.ndarray, data_b: np.ndarray, alternative: str, significance_level: float,
+    num_resamples: int = 10000, seed: Optional[np.random.SeedSequence] = None
+) -> str:
+    """ブートストラップ法で平均の差の信頼区間を求め、結果のサマリを出力する
+
+    信頼区間が0を含まない場合に、帰無仮説は棄却されると判定する。
+
+    Parameters
+    ----------
+    data_a : np.ndarray
+    data_b : np.ndarray
+    alternative : str
+        対立仮説。two-sided, less, greaterのいずれか。
+    significance_level : float
+        有意水準
+    num_resamples : int, optional
+        リサンプリングする回数。デフォルト値は10000
+    seed : np.random.SeedSequence, optional
+        乱数のシード
+
+    Returns
+    -------
+    str
+    """
+
+    num_resamples = _limit_resamples(num_resamples, len(data_a) + len(data_b))
+    result = bootstrap_confidence_interval(data_a, data_b, alternative, significance_level, num_resamples, seed=seed)
+
+    if result.low > 0 or result.high < 0:
+        test_result = '帰無仮説は棄却される'
+    else:
+        test_result = '帰無仮説は棄却されない'
+
+    lines = [
+        'データ群の関係 - 独立',
+        '帰無仮説       - データ群Aの平均 ＝ データ群Bの平均',
+        '対立仮説       - {}'.format(write_formal_alternative(alternative)),
+        '有意水準       - {}'.format(significance_level),
+        '検定方法       - ブートストラップ信頼区間',
+        '平均の差       - {}'.format(result.statistic),
+        '信頼区間       - [{}, {}] ({:.0%})'.format(result.low, result.high, 1 - significance_level),
+        'リサンプル回数 - {:,}'.format(result.num_resamples),
+        '検定結果       - {}'.format(test_result)
+    ]
+
+    summary = '\n'.join(lines)
+    return summary
+
+
+def _limit_resamples(num_resamples: int, num_data: int) -> int:
+    # リサンプリングするデータの要素数の合計が上限を超えないように、リサンプリングの回数を減らす
+    return max(1, min(num_resamples, max_resampling_elements // num_data))
+
+
+def _permutation_p_value(count: int, num_permutations: int) -> Tuple[float, float]:
+    # 観測値自身を並べ替えの1つとして数え、p値が0にならないようにする
+    p_value = (count + 1) / (num_permutations + 1)
+    standard_error = np.sqrt(p_value * (1 - p_value) / num_permutations)
+    return p_value, float(standard_error)
+
+
+class _ResamplingPool(object):
+    """リサンプリングのバッチを実行するクラス
+
+    生成時は呼び出したスレッドで順に実行する。startで残りのリサンプリングするデータの要素数の合計を渡し、
+    それがparallel_threshold以上の場合は、以降のバッチをプロセスプールで並列に実行する。
+    プロセスプールの各プロセスには、起動時にデータを1度だけ渡す。
+
+    Parameters
+    ----------
+    max_workers : int or None
+        プロセス数の上限。Noneの場合はCPUのコア数
+    *data
+        各バッチを実行する関数の先頭に渡す引数
+    """
+
+    def __init__(self, max_workers: Optional[int], *data):
+        self.num_workers = 1
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._data = data
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self, num_elements: int):
+        """残りのリサンプリングの量が多い場合に、プロセスプールを起動する
+
+        既に起動している場合は何もしない。
+
+        Parameters
+        ----------
+        num_elements : int
+            残りのリサンプリングするデータの要素数の合計
+        """
+
+        if self._executor is not None or num_elements < parallel_threshold or self._max_workers <= 1:
+            return
+
+        # Dashのリクエストを処理するスレッドから呼び出されるため、マルチスレッドのプロセスをforkしないように、
+        # spawnでプロセスを起動する
+        self._executor = ProcessPoolExecutor(
+            max_workers=self._max_workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=self._data
+        )
+        self.num_workers = self._max_workers
+
+    def map(self, function: Callable, tasks: List[tuple]) -> list:
+        """各バッチを実行する
+
+        Parameters
+        ----------
+        function : Callable
+            dataと、taskの各要素を引数に取る関数
+        tasks : list[tuple]
+
+        Returns
+        -------
+        list
+            各バッチの結果
+        """
+
+        if self._executor is None:
+            return [function(*self._data, *task) for task in tasks]
+
+        return list(self._executor.map(_run_in_worker, [(function, task) for task in tasks]))
+
+    def __enter__(self) -> '_ResamplingPool':
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+def _init_worker(*data):
+    # プロセスプールの各プロセスで、リサンプリングするデータを保持する
+    global _worker_data
+    _worker_data = data
+
+
+def _run_in_worker(function_task: Tuple[Callable, tuple]):
+    function, task = function_task
+    return function(*_worker_data, *task)
+
+
+def _count_extreme_permutations(
+    pooled: np.ndarray, num_data_a: int, size: int, seed_sequence: np.random.SeedSequence,
+    observed: float, alternative: str
+) -> int:
+    # 並べ替えたデータの平均の差が、観測値と同じかより極端になった回数を返す
+    rng = np.random.default_rng(seed_sequence)
+    # 一様乱数の行ごとに小さい方からnum_data_a個を選ぶと、データ群Aに割り当てる非復元抽出のインデックスとなる
+    indices = np.argpartition(rng.random((size, len(pooled))), num_data_a - 1, axis=1)[:, :num_data_a]
+    sum_a = pooled[indices].sum(axis=1)
+    differences = sum_a / num_data_a - (pooled.sum() - sum_a) / (len(pooled) - num_data_a)
+
+    # 浮動小数点数の誤差で、観測値と等しい並べ替えが極端でないと判定されないようにする
+    tolerance = 1e-9 * max(1.0, abs(observed))
+    if alternative == 'two-sided':
+        extreme = np.abs(differences) >= abs(observed) - tolerance
+    elif alternative == 'less':
+        extreme = differences <= observed + tolerance
+    else:
+        extreme = differences >= observed - tolerance
+
+    return int(np.count_nonzero(extreme))
+
+
+def _bootstrap_differences(
+    data_a: np.ndarray, data_b: np.ndarray, size: int, seed_sequence: np.random.SeedSequence
+) -> np.ndarray:
+    # 各データ群から復元抽出したデータの平均の差を返す
+    rng = np.random.default_rng(seed_sequence)
+    means_a = data_a[rng.integers(0, len(data_a), (size, len(data_a)))].mean(axis=1)
+    means_b = data_b[rng.integers(0, len(data_b), (size, len(data_b)))].mean(axis=1)
+    return means_a - means_b
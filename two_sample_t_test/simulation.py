@@ -0,0 +1,159 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy import stats
+
+
+# 1回の乱数生成で生成する要素数の上限。反復をchunkに分け、メモリ使用量をこの要素数程度に抑える
+max_chunk_elements = 1000000
+
+# 生成するデータの要素数の合計がこの値以上の場合、プロセスプールで並列に実行する
+# プロセスの起動にかかる時間より、データの生成とt検定にかかる時間が十分に長くなる要素数とする
+parallel_threshold = 50000000
+
+
+def simulate_rejection_rates(
+    differences: np.ndarray, num_data_a: int, num_data_b: int, variance_a: float, variance_b: float,
+    alternative: str, significance_level: float, num_replicates: int, equal_var: bool = True,
+    seed: Optional[int] = None, max_workers: Optional[int] = None
+) -> np.ndarray:
+    """平均の差ごとに、2標本t検定で帰無仮説が棄却される割合をモンテカルロ法で求める
+
+    平均の差ごとにnum_replicates組の標本を2次元配列として生成し、
+    全ての組のt検定をscipy.stats.ttest_indで一度に実行する。
+    平均の差が0の場合の棄却率は第一種の過誤の確率、0以外の場合は検出力の推定値となる。
+
+    Parameters
+    ----------
+    differences : np.ndarray
+        データ群Aの平均からデータ群Bの平均を引いた差
+    num_data_a : int
+        データ群Aのデータ数
+    num_data_b : int
+        データ群Bのデータ数
+    variance_a : float
+        データ群Aの分散
+    variance_b : float
+        データ群Bの分散
+    alternative : str
+        対立仮説。two-sided, less, greaterのいずれか。
+    significance_level : float
+        有意水準
+    num_replicates : int
+        平均の差ごとの反復回数
+    equal_var : bool, optional
+        Trueの場合はスチューデントのt検定、Falseの場合はウェルチのt検定を行う。デフォルト値はTrue
+    seed : int, optional
+        シード値。Noneの場合は、毎回異なる結果となる
+    max_workers : int, optional
+        並列に実行する場合のプロセス数。Noneの場合はCPUのコア数
+
+    Returns
+    -------
+    np.ndarray
+        平均の差ごとの棄却率
+    """
+
+    assert num_replicates > 0
+
+    chunk_size = max(1, max_chunk_elements // (num_data_a + num_data_b))
+    chunk_sizes = [min(chunk_size, num_replicates - start) for start in range(0, num_replicates, chunk_size)]
+
+    # chunkごとに独立した乱数の系列を使うため、並列に実行するかによらず同じシード値で同じ結果となる
+    seed_sequences = iter(np.random.SeedSequence(seed).spawn(len(differences) * len(chunk_sizes)))
+    tasks = [
+        (
+            difference, num_data_a, num_data_b, variance_a, variance_b,
+            alternative, significance_level, equal_var, size, next(seed_sequences)
+        )
+        for difference in differences
+        for size in chunk_sizes
+    ]
+
+    num_elements = (num_data_a + num_data_b) * num_replicates * len(differences)
+    if num_elements >= parallel_threshold and len(tasks) > 1:
+        # Dashのリクエストを処理するスレッドから呼び出されるため、マルチスレッドのプロセスをforkしないように、
+        # spawnでプロセスを起動する
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+            counts = list(executor.map(_count_rejections, tasks))
+    else:
+        counts = [_count_rejections(task) for task in tasks]
+
+    rejections = np.array(counts).reshape(len(differences), len(chunk_sizes)).sum(axis=1)
+    return rejections / num_replicates
+
+
+def theoretical_rejection_rates(
+    differences: np.ndarray, num_data_a: int, num_data_b: int, variance_a: float, variance_b: float,
+    alternative: str, significance_level: float, equal_var: bool = True
+) -> np.ndarray:
+    """平均の差ごとに、2標本t検定で帰無仮説が棄却される確率を非心t分布から求める
+
+    スチューデントのt検定で2つのデータ群の分散が等しい場合は厳密な値となる。
+    分散が異なる場合やウェルチのt検定の場合は近似値となる。
+
+    Parameters
+    ----------
+    differences : np.ndarray
+        データ群Aの平均からデータ群Bの平均を引いた差
+    num_data_a : int
+        データ群Aのデータ数
+    num_data_b : int
+        データ群Bのデータ数
+    variance_a : float
+        データ群Aの分散
+    variance_b : float
+        データ群Bの分散
+    alternative : str
+        対立仮説。two-sided, less, greaterのいずれか。
+    significance_level : float
+        有意水準
+    equal_var : bool, optional
+        Trueの場合はスチューデントのt検定、Falseの場合はウェルチのt検定の棄却率を求める。デフォルト値はTrue
+
+    Returns
+    -------
+    np.ndarray
+        平均の差ごとの棄却率
+    """
+
+    df: float
+    if equal_var:
+        df = num_data_a + num_data_b - 2
+        pooled_variance = ((num_data_a - 1) * variance_a + (num_data_b - 1) * variance_b) / df
+        standard_error = np.sqrt(pooled_variance * (1 / num_data_a + 1 / num_data_b))
+    else:
+        # ウェルチ=サタスウェイトの式で自由度を近似する
+        squared_error_a = variance_a / num_data_a
+        squared_error_b = variance_b / num_data_b
+        standard_error = np.sqrt(squared_error_a + squared_error_b)
+        df = (squared_error_a + squared_error_b) ** 2 / (
+            squared_error_a ** 2 / (num_data_a - 1) + squared_error_b ** 2 / (num_data_b - 1)
+        )
+    noncentrality = np.asarray(differences) / standard_error
+
+    if alternative == 'two-sided':
+        critical_value = stats.t.ppf(1 - significance_level / 2, df)
+        return stats.nct.sf(critical_value, df, noncentrality) + stats.nct.cdf(-critical_value, df, noncentrality)
+    elif alternative == 'less':
+        critical_value = stats.t.ppf(1 - significance_level, df)
+        return stats.nct.cdf(-critical_value, df, noncentrality)
+    else:
+        critical_value = stats.t.ppf(1 - significance_level, df)
+        return stats.nct.sf(critical_value, df, noncentrality)
+
+
+def _count_rejections(task: Tuple) -> int:
+    # 1つのchunkの標本を生成し、帰無仮説が棄却された組の数を返す。プロセスプールから呼び出すため、モジュールの関数とする
+    (difference, num_data_a, num_data_b, variance_a, variance_b,
+     alternative, significance_level, equal_var, size, seed_sequence) = task
+
+    rng = np.random.default_rng(seed_sequence)
+    data_a = rng.normal(difference, np.sqrt(variance_a), (size, num_data_a))
+    data_b = rng.normal(0, np.sqrt(variance_b), (size, num_data_b))
+
+    _, p_values = stats.ttest_ind(data_a, data_b, axis=1, equal_var=equal_var, alternative=alternative)
+    return int(np.count_nonzero(p_values < significance_level))
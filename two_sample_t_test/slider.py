@@ -61,6 +61,9 @@ class ParameterSlider(object):
 class NumDataParameterSlider(ParameterSlider):
     """データ数パラメータのスライダーを生成するクラス
 
+    データ数は10から1,000,000までの広い範囲を扱うため、スライダーの値はデータ数の常用対数とする。
+    スライダーの値は、to_num_dataでデータ数に変換する。
+
     Parameters
     ----------
     id_ : str
@@ -68,13 +71,44 @@ class NumDataParameterSlider(ParameterSlider):
     """
 
     def __init__(self, id_: str):
-        min_ = 10
-        max_ = 50
-        step = 5
-        default = 20
-        markers_step = 10
+        min_ = 1
+        max_ = 6
+        step = 0.01
+        default = 1.3
+        markers_step = 1
         ParameterSlider.__init__(self, id_, min_, max_, step, default, markers_step)
 
+    def to_slider(self) -> dcc.Slider:
+        """dcc.Sliderインスタンスを生成する
+
+        Returns
+        -------
+        dcc.Slider
+        """
+
+        slider = ParameterSlider.to_slider(self)
+        slider.marks = {
+            v: format_num_data(self.to_num_data(v))
+            for v in range(self.min_, self.max_ + self.markers_step, self.markers_step)
+        }
+        return slider
+
+    @staticmethod
+    def to_num_data(value: float) -> int:
+        """スライダーの値をデータ数に変換する
+
+        Parameters
+        ----------
+        value : float
+            スライダーの値
+
+        Returns
+        -------
+        int
+        """
+
+        return int(round(10 ** value))
+
 
 class LocParameterSlider(ParameterSlider):
     """位置パラメータのスライダーを生成するクラス
@@ -113,3 +147,23 @@ class VarianceParameterSlider(ParameterSlider):
         default = 1
         markers_step = 1
         ParameterSlider.__init__(self, id_, min_, max_, step, default, markers_step, disabled=disabled)
+
+
+def format_num_data(num_data: int) -> str:
+    """データ数を、スライダーのマークに表示する短い表記に変換する
+
+    Parameters
+    ----------
+    num_data : int
+
+    Returns
+    -------
+    str
+        例えば、1000は1K、1000000は1Mとなる
+    """
+
+    for unit, size in (('M', 1000000), ('K', 1000)):
+        if num_data >= size:
+            return f'{num_data // size}{unit}'
+
+    return str(num_data)
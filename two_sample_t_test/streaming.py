@@ -0,0 +1,142 @@
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+from ttest import SampleStats, compute_sample_stats, merge_sample_stats
+
+
+# 描写するために保持する、各データ群のデータ数の上限
+reservoir_size = 500
+
+
+class StreamState(NamedTuple):
+    """ストリーミングで受け取ったデータの状態
+
+    これまでに受け取った全てのデータは保持せず、十分統計量と描写用のサンプルだけを保持する。
+
+    Attributes
+    ----------
+    stats_a : ttest.SampleStats
+        データ群Aの十分統計量
+    stats_b : ttest.SampleStats
+        データ群Bの十分統計量
+    reservoir_a : List[float]
+        データ群Aから一様に抽出した、最大reservoir_size個のデータ
+    reservoir_b : List[float]
+        データ群Bから一様に抽出した、最大reservoir_size個のデータ
+    num_batches : int
+        これまでに受け取ったバッチの数
+    """
+
+    stats_a: SampleStats
+    stats_b: SampleStats
+    reservoir_a: List[float]
+    reservoir_b: List[float]
+    num_batches: int
+
+    def to_dict(self) -> dict:
+        """dcc.Storeに保存するために、dictに変換する
+
+        Returns
+        -------
+        dict
+        """
+
+        return {
+            'stats_a': list(self.stats_a),
+            'stats_b': list(self.stats_b),
+            'reservoir_a': list(self.reservoir_a),
+            'reservoir_b': list(self.reservoir_b),
+            'num_batches': self.num_batches
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'StreamState':
+        """to_dictで変換したdictから復元する
+
+        Parameters
+        ----------
+        data : dict
+
+        Returns
+        -------
+        StreamState
+        """
+
+        return cls(
+            SampleStats(*data['stats_a']),
+            SampleStats(*data['stats_b']),
+            data['reservoir_a'],
+            data['reservoir_b'],
+            data['num_batches']
+        )
+
+
+def append_batch(
+    state: Optional[StreamState], batch_a: np.ndarray, batch_b: np.ndarray, rng: np.random.Generator
+) -> StreamState:
+    """ストリーミングの状態に、新しく受け取ったバッチを追加する
+
+    十分統計量はバッチの十分統計量と合わせて更新し、描写用のサンプルはリザーバーサンプリングで更新する。
+    計算量はバッチのデータ数に比例し、これまでに受け取ったデータ数によらない。
+
+    Parameters
+    ----------
+    state : StreamState or None
+        Noneの場合は、新しくストリーミングを開始する
+    batch_a : np.ndarray
+        データ群Aに追加するデータ
+    batch_b : np.ndarray
+        データ群Bに追加するデータ
+    rng : np.random.Generator
+        リザーバーサンプリングに使う乱数生成器
+
+    Returns
+    -------
+    StreamState
+    """
+
+    if state is None:
+        empty = SampleStats(0, 0.0, 0.0)
+        state = StreamState(empty, empty, [], [], 0)
+
+    return StreamState(
+        merge_sample_stats(state.stats_a, compute_sample_stats(batch_a)),
+        merge_sample_stats(state.stats_b, compute_sample_stats(batch_b)),
+        update_reservoir(state.reservoir_a, state.stats_a.num_data, batch_a, rng),
+        update_reservoir(state.reservoir_b, state.stats_b.num_data, batch_b, rng),
+        state.num_batches + 1
+    )
+
+
+def update_reservoir(reservoir: List[float], num_seen: int, batch: np.ndarray, rng: np.random.Generator) -> List[float]:
+    """リザーバーサンプリングで、これまでのデータから一様に抽出したサンプルを更新する
+
+    Parameters
+    ----------
+    reservoir : List[float]
+        これまでのデータから抽出した、最大reservoir_size個のサンプル
+    num_seen : int
+        これまでのデータ数
+    batch : np.ndarray
+        新しく受け取ったデータ
+    rng : np.random.Generator
+
+    Returns
+    -------
+    List[float]
+        更新したサンプル
+    """
+
+    # サンプルがreservoir_size個に満たない間は、そのまま追加する
+    num_fill = max(0, min(reservoir_size - len(reservoir), len(batch)))
+    sample = np.concatenate([reservoir, batch[:num_fill]])
+    rest = batch[num_fill:]
+
+    # i番目(0始まり)のデータは、確率reservoir_size / (i + 1)でサンプルの一様に選んだ位置と置き換える
+    # 同じ位置が複数回選ばれた場合は、後のデータで上書きされる
+    positions = rng.integers(0, num_seen + num_fill + np.arange(len(rest)) + 1)
+    replaced = positions < reservoir_size
+    sample[positions[replaced]] = rest[replaced]
+
+    return sample.tolist()
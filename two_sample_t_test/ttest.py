@@ -1,33 +1,176 @@
-from typing import List
+from typing import NamedTuple, Tuple
 
+import numpy as np
 from scipy import stats
 
 
-def perform_ttest(data_a: List[float], data_b: List[float], alternative: str, significance_level: float) -> str:
+class SampleStats(NamedTuple):
+    """データ群の十分統計量
+
+    Attributes
+    ----------
+    num_data : int
+        データ数
+    mean : float
+        標本平均
+    m2 : float
+        平均からの偏差の2乗和
+    """
+
+    num_data: int
+    mean: float
+    m2: float
+
+    def variance(self, ddof: int = 0) -> float:
+        """分散を計算する
+
+        Parameters
+        ----------
+        ddof : int, optional
+            自由度の補正。0の場合は標本分散、1の場合は不偏分散。デフォルト値は0
+
+        Returns
+        -------
+        float
+        """
+
+        return self.m2 / (self.num_data - ddof)
+
+
+def compute_sample_stats(data: np.ndarray) -> SampleStats:
+    """データ群のデータ数、標本平均、偏差の2乗和を計算する
+
+    統計情報テーブルとt検定は、全てこの結果から計算し、データを何度も走査しないようにする。
+
+    Parameters
+    ----------
+    data : np.ndarray
+        1次元の配列
+
+    Returns
+    -------
+    SampleStats
+    """
+
+    assert data.ndim == 1
+
+    num_data = data.size
+    mean = data.sum() / num_data
+    # 偏差の2乗和を平均を引いてから計算し、データの値が大きい場合の桁落ちを避ける
+    deviations = data - mean
+    m2 = np.dot(deviations, deviations)
+    return SampleStats(num_data, float(mean), float(m2))
+
+
+def merge_sample_stats(stats_a: SampleStats, stats_b: SampleStats) -> SampleStats:
+    """2つのデータの十分統計量から、それらを合わせたデータの十分統計量を計算する
+
+    Chanらの方法で平均と偏差の2乗和を更新するため、元のデータを走査する必要はない。
+
+    Parameters
+    ----------
+    stats_a : SampleStats
+    stats_b : SampleStats
+
+    Returns
+    -------
+    SampleStats
+    """
+
+    if stats_a.num_data == 0:
+        return stats_b
+    if stats_b.num_data == 0:
+        return stats_a
+
+    num_data = stats_a.num_data + stats_b.num_data
+    delta = stats_b.mean - stats_a.mean
+    mean = stats_a.mean + delta * stats_b.num_data / num_data
+    m2 = stats_a.m2 + stats_b.m2 + delta ** 2 * stats_a.num_data * stats_b.num_data / num_data
+    return SampleStats(num_data, mean, m2)
+
+
+def compute_ttest(
+    stats_a: SampleStats, stats_b: SampleStats, alternative: str, equal_var: bool = True
+) -> Tuple[float, float]:
+    """2つのデータ群の十分統計量から、2標本t検定のt検定値とp値を計算する
+
+    Parameters
+    ----------
+    stats_a : SampleStats
+    stats_b : SampleStats
+    alternative : str
+        対立仮説。two-sided, less, greaterのいずれか。
+    equal_var : bool, optional
+        Trueの場合はスチューデントのt検定、Falseの場合はウェルチのt検定を行う。デフォルト値はTrue
+
+    Returns
+    -------
+    t : float
+        t検定値
+    p_value : float
+        p値
+    """
+
+    df: float
+    if equal_var:
+        df = stats_a.num_data + stats_b.num_data - 2
+        pooled_variance = (stats_a.m2 + stats_b.m2) / df
+        standard_error = np.sqrt(pooled_variance * (1 / stats_a.num_data + 1 / stats_b.num_data))
+    else:
+        # ウェルチ=サタスウェイトの式で自由度を近似する
+        squared_error_a = stats_a.variance(ddof=1) / stats_a.num_data
+        squared_error_b = stats_b.variance(ddof=1) / stats_b.num_data
+        standard_error = np.sqrt(squared_error_a + squared_error_b)
+        df = (squared_error_a + squared_error_b) ** 2 / (
+            squared_error_a ** 2 / (stats_a.num_data - 1) + squared_error_b ** 2 / (stats_b.num_data - 1)
+        )
+
+    t = (stats_a.mean - stats_b.mean) / standard_error
+
+    if alternative == 'two-sided':
+        p_value = 2 * stats.t.sf(abs(t), df)
+    elif alternative == 'less':
+        p_value = stats.t.cdf(t, df)
+    else:
+        p_value = stats.t.sf(t, df)
+
+    return float(t), float(p_value)
+
+
+def perform_ttest(
+    stats_a: SampleStats, stats_b: SampleStats, alternative: str, significance_level: float,
+    equal_var: bool = True
+) -> str:
     """2標本t検定を実行し、結果のサマリを出力する
 
     Parameters
     ----------
-    data_a : list_like[float]
-    data_b : list_like[float]
+    stats_a : SampleStats
+        データ群Aの十分統計量
+    stats_b : SampleStats
+        データ群Bの十分統計量
     alternative : str
         対立仮説。two-sided, less, greaterのいずれか。
         参考: https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.ttest_ind.html
     significance_level : float
         有意水準
+    equal_var : bool, optional
+        Trueの場合はスチューデントのt検定、Falseの場合はウェルチのt検定を行う。デフォルト値はTrue
 
     Returns
     -------
     str
     """
 
-    t, p_value = stats.ttest_ind(data_a, data_b, equal_var=True, alternative=alternative)
+    t, p_value = compute_ttest(stats_a, stats_b, alternative, equal_var)
 
-    ttest_summary = write_ttest_summary(t, p_value, alternative, significance_level)
+    ttest_summary = write_ttest_summary(t, p_value, alternative, significance_level, equal_var)
     return ttest_summary
 
 
-def write_ttest_summary(t: float, p_value: float, alternative: str, significance_level: float) -> str:
+def write_ttest_summary(
+    t: float, p_value: float, alternative: str, significance_level: float, equal_var: bool = True
+) -> str:
     """t検定のサマリを出力する
 
     Parameters
@@ -41,6 +184,8 @@ def write_ttest_summary(t: float, p_value: float, alternative: str, significance
         参考: https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.ttest_ind.html
     significance_level : float
         有意水準
+    equal_var : bool, optional
+        等分散を仮定した場合はTrue。デフォルト値はTrue
 
     Returns
     -------
@@ -56,9 +201,9 @@ def write_ttest_summary(t: float, p_value: float, alternative: str, significance
         'データ群の関係 - 独立',
         '帰無仮説       - データ群Aの平均 ＝ データ群Bの平均',
         '対立仮説       - {}'.format(write_formal_alternative(alternative)),
-        '等分散の仮定   - あり',
+        '等分散の仮定   - {}'.format('あり' if equal_var else 'なし'),
         '有意水準       - {}'.format(significance_level),
-        '検定方法       - スチューデントのt検定',
+        '検定方法       - {}'.format('スチューデントのt検定' if equal_var else 'ウェルチのt検定'),
         't検定値        - {}'.format(t),
         'p値            - {}'.format(p_value),
         '検定結果       - {}'.format(ttest_result)